@@ -0,0 +1,421 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Benchmarks for frycook.  Each benchmark runs part of a frycooker run
+against the stand-in hosts in fake_transport.py and records its wall
+time along with the round trips and bytes it would have sent to a real
+host.  Results are saved as JSON in the results directory under a label,
+usually the frycook release, so that releases can be compared::
+
+  python benchmarks/bench.py --label 0.3.9
+  python benchmarks/bench.py --compare 0.3.9
+
+Run it from anywhere with fabric, cuisine, and mako installed; it uses
+the frycook in this checkout and the recipes, cookbooks, and packages
+in sample/.
+'''
+
+import argparse
+import contextlib
+import json
+import os
+import os.path
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+TOP = os.path.dirname(HERE)
+sys.path[:0] = [os.path.join(TOP, 'src'), os.path.join(TOP, 'sample', 'setup')]
+
+from fabric.api import env  # noqa
+import frycook  # noqa
+import frycooker  # noqa
+from frycook import Recipe  # noqa
+from frycook import connections  # noqa
+from frycook import facts  # noqa
+from frycook import handlers  # noqa
+from frycook import push_cache  # noqa
+from frycook import timing  # noqa
+from frycook.environment import Environment  # noqa
+from fake_transport import RecordingTransport  # noqa
+
+# host most of the single host benchmarks run against
+HOST = 'bench0'
+
+
+@contextlib.contextmanager
+def quiet():
+    '''
+    Throw away what frycook prints while a benchmark runs.
+    '''
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def make_enviro(count):
+    '''
+    Make an environment with count computers, all in one group, shaped
+    like the sample's dev computer.
+
+    :type count: int
+    :param count: number of computers
+
+    :rtype: Environment
+    :return: environment
+    '''
+    sample = json.load(open(os.path.join(TOP, 'sample', 'setup',
+                                         'environment.json')))
+    computers = {}
+    for i in range(count):
+        name = 'bench%d' % i
+        computers[name] = {
+            "domain_name": "bench.example",
+            "host_group": "bench",
+            "public_ifaces": ["eth0"],
+            "public_ips": {"192.0.%d.%d" % (i >> 8 & 255, i & 255):
+                           "%s.bench.example" % name},
+            "private_ifaces": ["eth1"],
+            "private_ips": {"10.%d.%d.%d" % (i >> 16 & 255, i >> 8 & 255,
+                                             i & 255): name},
+            "components": [{"type": "cookbook", "name": "base"}]}
+    return Environment({"users": sample["users"],
+                        "computers": computers,
+                        "groups": {"bench": {"computers": sorted(computers)}}})
+
+
+class Context(object):
+    '''
+    What the benchmarks need: settings pointing at a scratch directory,
+    an environment, and the arguments frycooker.py would have parsed.
+    '''
+    def __init__(self, work_dir, hosts):
+        '''
+        :type work_dir: string
+        :param work_dir: scratch directory
+        :type hosts: int
+        :param hosts: number of computers in the environment
+        '''
+        self.work_dir = work_dir
+        self.enviro = make_enviro(hosts)
+        self.args = argparse.Namespace(
+            user=None, keyfile=None, ok_to_be_rude=True, no_prompt=True,
+            package_update=False)
+
+    def settings(self, **extra):
+        '''
+        Make a fresh settings dictionary.
+
+        :type extra: keyword arguments
+        :param extra: settings to add
+
+        :rtype: dict
+        :return: settings dictionary
+        '''
+        settings = {"package_dir": os.path.join(TOP, 'sample', 'packages'),
+                    "file_ignores": ".*~",
+                    "tmp_dir": self.work_dir,
+                    "cache_dir": tempfile.mkdtemp(dir=self.work_dir),
+                    "params": {}}
+        settings.update(extra)
+        return settings
+
+    def recipe(self, host=HOST, **extra):
+        '''
+        Make a recipe to call the push functions on, pointing fabric at
+        a benchmark host.
+
+        :type host: string
+        :param host: name of the host
+        :type extra: keyword arguments
+        :param extra: settings to add
+
+        :rtype: Recipe
+        :return: recipe
+        '''
+        env.host_string = host
+        return Recipe(self.settings(**extra), self.enviro, True, True)
+
+
+# Each benchmark takes the context and returns two functions: one that
+# gets things ready and isn't timed, and one that's timed.  Both are
+# called once per repetition.
+
+def bench_push_package_file_set(ctx):
+    recipe = ctx.recipe()
+
+    def prepare():
+        facts.gather_facts()
+
+    def run():
+        recipe.push_package_file_set('shorewall', HOST, bulk=False)
+    return prepare, run
+
+
+def bench_push_package_file_set_bulk(ctx):
+    recipe = ctx.recipe()
+
+    def prepare():
+        facts.gather_facts()
+
+    def run():
+        recipe.push_package_file_set('shorewall', HOST, bulk=True)
+    return prepare, run
+
+
+def bench_push_package_file_set_batched(ctx):
+    # fabric points at a host of its own, since each host keeps the
+    # transport it started with
+    recipe = ctx.recipe('bench-batched', batch_commands=True)
+
+    def prepare():
+        facts.gather_facts()
+
+    def run():
+        recipe.push_package_file_set('shorewall', HOST, bulk=False)
+    return prepare, run
+
+
+def bench_push_package_file_set_cached(ctx):
+    # everything is already in the push cache, so nothing should be sent
+    recipe = ctx.recipe(push_cache=True)
+    facts.gather_facts()
+    recipe.push_package_file_set('shorewall', HOST, bulk=False)
+
+    def prepare():
+        pass
+
+    def run():
+        recipe.push_package_file_set('shorewall', HOST, bulk=False)
+    return prepare, run
+
+
+def bench_push_template(ctx):
+    # hosts.tmplt loops over every computer in the environment
+    recipe = ctx.recipe()
+    template_env = {"host": HOST,
+                    "sibs": ctx.enviro.siblings(HOST, "bench"),
+                    "computers": ctx.enviro["computers"]}
+
+    def prepare():
+        pass
+
+    def run():
+        recipe.push_template('hosts/etc/hosts.tmplt', '/etc/hosts',
+                             template_env, 'root', 'root', '644')
+    return prepare, run
+
+
+def _apply(ctx, settings, hosts):
+    run_list = [{"type": "cookbook", "name": "base"}]
+
+    def prepare():
+        handlers.clear_handlers()
+        connections.disconnect()
+
+    def run():
+        for host in hosts:
+            frycooker.apply_host(ctx.enviro, settings, ctx.args, host,
+                                 run_list)
+    return prepare, run
+
+
+def bench_cookbook_base(ctx):
+    return _apply(ctx, ctx.settings(), [HOST])
+
+
+def bench_fleet(ctx, count):
+    hosts = sorted(ctx.enviro["computers"])[:count]
+    return _apply(ctx, ctx.settings(), hosts)
+
+
+BENCHMARKS = [
+    ('push_package_file_set', bench_push_package_file_set),
+    ('push_package_file_set_bulk', bench_push_package_file_set_bulk),
+    ('push_package_file_set_batched', bench_push_package_file_set_batched),
+    ('push_package_file_set_cached', bench_push_package_file_set_cached),
+    ('push_template', bench_push_template),
+    ('cookbook_base', bench_cookbook_base),
+]
+
+
+def run_benchmark(ctx, transport, benchmark, repeat):
+    '''
+    Run one benchmark repeat times.
+
+    :type ctx: Context
+    :param ctx: benchmark context
+    :type transport: RecordingTransport
+    :param transport: stand-in transport, already installed
+    :type benchmark: function
+    :param benchmark: benchmark function, with any arguments bound
+    :type repeat: int
+    :param repeat: number of times to run it
+
+    :rtype: dict
+    :return: wall times, and the transport's totals for one run
+    '''
+    times = []
+    with quiet():
+        prepare, run = benchmark(ctx)
+        for i in range(repeat):
+            prepare()
+            transport.reset()
+            timing.clear_records()
+            start = time.time()
+            run()
+            times.append(time.time() - start)
+        connections.disconnect()
+        push_cache.save_push_caches()
+    times.sort()
+    result = {"repeat": repeat,
+              "wall_median": times[len(times) // 2],
+              "wall_min": times[0],
+              "wall_max": times[-1]}
+    result.update(transport.stats())
+    return result
+
+
+def get_args():
+    '''
+    Parse the command line arguments.
+
+    :rtype: args object
+    :return: object containing attributes for all possible command-line parameters
+    '''
+    parser = argparse.ArgumentParser(
+        description='Benchmark frycook against stand-in hosts.')
+    parser.add_argument('-c', '--compare', metavar='LABEL',
+                        help='compare with the results saved under LABEL')
+    parser.add_argument('-H', '--hosts', default='10,100', metavar='N,N...',
+                        help='fleet sizes to run (default 10,100)')
+    parser.add_argument('-l', '--label', default='current',
+                        help='label to save results under (default current)')
+    parser.add_argument('--latency', type=float, default=0.0,
+                        metavar='SECONDS',
+                        help='simulated latency of each round trip')
+    parser.add_argument('-n', '--repeat', type=int, default=5,
+                        help='times to run each benchmark (default 5)')
+    parser.add_argument('-o', '--output', default=os.path.join(HERE,
+                                                                'results'),
+                        metavar='DIR',
+                        help='directory holding saved results')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run, by name or name prefix '
+                        '(default all)')
+    return parser.parse_args()
+
+
+def output_results(results, previous):
+    '''
+    Print a table of results, with the changes since previous results if
+    there are any.
+
+    :type results: dict
+    :param results: benchmark name -> result
+    :type previous: dict
+    :param previous: benchmark name -> earlier result
+    '''
+    print "%-30s %10s %8s %10s" % ('benchmark', 'wall ms', 'trips', 'bytes')
+    for name in sorted(results):
+        result = results[name]
+        print "%-30s %10.1f %8d %10d" % (name, result["wall_median"] * 1000,
+                                         result["round_trips"],
+                                         result["bytes_sent"])
+        old = previous.get(name)
+        if old:
+            changes = []
+            for key in ("wall_median", "round_trips", "bytes_sent"):
+                if old[key]:
+                    changes.append("%+.1f%%" % (
+                        (result[key] - old[key]) * 100.0 / old[key]))
+                else:
+                    changes.append("%+g" % (result[key] - old[key]))
+            print "%-30s %10s %8s %10s" % ('', changes[0], changes[1],
+                                           changes[2])
+
+
+def main():
+    '''
+    Main function for the benchmark program.
+    '''
+    args = get_args()
+
+    benchmarks = list(BENCHMARKS)
+    for count in [int(n) for n in args.hosts.split(',') if n]:
+        benchmarks.append(('fleet_%d' % count,
+                           lambda ctx, count=count: bench_fleet(ctx, count)))
+    if args.benchmarks:
+        benchmarks = [(name, func) for name, func in benchmarks
+                      if [b for b in args.benchmarks if name.startswith(b)]]
+    hosts = max([1] + [int(n) for n in args.hosts.split(',') if n])
+
+    previous = {}
+    if args.compare:
+        filename = os.path.join(args.output, '%s.json' % args.compare)
+        previous = json.load(open(filename))["benchmarks"]
+
+    work_dir = tempfile.mkdtemp(prefix='fck-bench-')
+    results = {}
+    try:
+        ctx = Context(work_dir, hosts)
+        with RecordingTransport(args.latency) as transport:
+            for name, benchmark in benchmarks:
+                print "running %s" % name
+                results[name] = run_benchmark(ctx, transport, benchmark,
+                                              args.repeat)
+    finally:
+        shutil.rmtree(work_dir)
+
+    output_results(results, previous)
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    filename = os.path.join(args.output, '%s.json' % args.label)
+    json.dump({"label": args.label,
+               "frycook_version": frycook.__version__,
+               "python_version": platform.python_version(),
+               "date": time.strftime('%Y-%m-%d %H:%M:%S'),
+               "latency": args.latency,
+               "hosts": hosts,
+               "repeat": args.repeat,
+               "benchmarks": results},
+              open(filename, 'w'), sort_keys=True, indent=4,
+              separators=(',', ': '))
+    print "results saved to %s" % filename
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+A stand-in for the remote side of a frycooker run.  RecordingTransport
+replaces the cuisine and fabric calls that reach a remote host with ones
+that just record the call, so frycook's own work (planning, rendering,
+hashing, archiving, scheduling) runs for real while the network is left
+out.  For each call it records one round trip and the bytes that would
+have been sent.
+
+The remote host looks like a freshly installed one: nothing exists,
+nothing is installed, and commands print nothing.  A cuisine helper that
+runs several commands of its own counts as a single round trip, so the
+counts are a lower bound, but they're comparable from one frycook
+release to the next, which is what they're for.  Setting latency adds
+that many seconds to every round trip, to see how a run behaves when
+it's waiting on the network.
+'''
+
+import os.path
+import threading
+import time
+
+import cuisine
+import fabric.api
+import fabric.operations
+
+from frycook import connections
+from frycook import recipe_template
+from frycook import transport
+
+# cuisine calls that reach the remote host, with what the stand-in
+# returns for them; run and sudo return an empty result
+CUISINE_CALLS = {
+    'dir_attribs': None,
+    'dir_ensure': None,
+    'dir_exists': False,
+    'file_attribs': None,
+    'file_ensure': None,
+    'file_exists': False,
+    'file_link': None,
+    'file_read': '',
+    'file_sha256': '',
+    'file_unlink': None,
+    'file_upload': None,
+    'file_write': None,
+    'group_check': None,
+    'group_create': None,
+    'group_ensure': None,
+    'group_user_add': None,
+    'group_user_ensure': None,
+    'package_ensure': None,
+    'package_install': None,
+    'package_update': None,
+    'package_upgrade': None,
+    'ssh_authorize': None,
+    'ssh_keygen': None,
+    'upstart_ensure': None,
+    'user_check': None,
+    'user_create': None,
+    'user_ensure': None,
+}
+
+
+class FakeResult(str):
+    '''
+    What fabric returns from a remote command that succeeded without
+    printing anything.
+    '''
+    succeeded = True
+    failed = False
+    return_code = 0
+    stderr = ''
+
+
+class _FakeConnection(object):
+    '''
+    Stands in for a paramiko client in the fake connection cache.
+    '''
+    def close(self):
+        pass
+
+
+class _FakeConnections(dict):
+    '''
+    Stands in for fabric's connection cache, so "connecting" to a host
+    doesn't open a socket.
+    '''
+    def __missing__(self, host):
+        self[host] = _FakeConnection()
+        return self[host]
+
+
+def _size(value):
+    '''
+    How many bytes sending a value would take.
+
+    :type value: anything
+    :param value: an argument passed to a remote call
+
+    :rtype: int
+    :return: size in bytes
+    '''
+    if isinstance(value, basestring):
+        return len(value)
+    if hasattr(value, 'getvalue'):
+        return len(value.getvalue())
+    return 0
+
+
+class RecordingTransport(object):
+    '''
+    Records the remote calls made while it's installed.  Use it as a
+    context manager::
+
+      transport = RecordingTransport()
+      with transport:
+          recipe.push_package_file_set('nginx', 'bench0')
+      print transport.stats()
+    '''
+    def __init__(self, latency=0.0):
+        '''
+        :type latency: float
+        :param latency: seconds to wait on each round trip
+        '''
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.saved = []
+        self.reset()
+
+    def reset(self):
+        '''
+        Forget the calls recorded so far.
+        '''
+        with self.lock:
+            self.round_trips = 0
+            self.bytes_sent = 0
+            self.calls = {}
+
+    def record(self, name, sent=0, round_trip=True):
+        '''
+        Record one call.
+
+        :type name: string
+        :param name: name of the call
+        :type sent: int
+        :param sent: bytes sent to the host
+        :type round_trip: boolean
+        :param round_trip: whether the call waits on the host
+        '''
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            self.bytes_sent += sent
+            if round_trip:
+                self.round_trips += 1
+        if round_trip and self.latency:
+            time.sleep(self.latency)
+
+    def stats(self):
+        '''
+        Get the totals for the calls recorded so far.
+
+        :rtype: dict
+        :return: round trips, bytes sent, and count of each call
+        '''
+        with self.lock:
+            return {"round_trips": self.round_trips,
+                    "bytes_sent": self.bytes_sent,
+                    "calls": dict(self.calls)}
+
+    def _command(self, name):
+        def command(cmd, *args, **kwargs):
+            self.record(name, len(cmd))
+            return FakeResult('')
+        return command
+
+    def _cuisine_call(self, name, result):
+        def call(*args, **kwargs):
+            sent = sum([_size(a) for a in args + tuple(kwargs.values())])
+            if name == 'file_upload':
+                # file_upload(remote, local)
+                local = args[1] if len(args) > 1 else kwargs.get('local')
+                sent += os.path.getsize(local)
+            self.record(name, sent)
+            return result
+        return call
+
+    def _put(self, local_path, remote_path, *args, **kwargs):
+        if isinstance(local_path, basestring):
+            sent = os.path.getsize(local_path)
+        else:
+            sent = _size(local_path)
+        self.record('put', sent)
+        return [remote_path]
+
+    def _local(self, command, capture=False, *args, **kwargs):
+        # local commands run on this machine; the ones frycook runs
+        # mostly start or stop ssh control masters and push with rsync
+        self.record('local', round_trip=('ssh' in command))
+        return FakeResult('')
+
+    def _patch(self, obj, name, value):
+        self.saved.append((obj, name, getattr(obj, name)))
+        setattr(obj, name, value)
+
+    def install(self):
+        '''
+        Put the stand-in calls in place of the real ones.
+        '''
+        self._patch(cuisine, 'run', self._command('run'))
+        self._patch(cuisine, 'sudo', self._command('sudo'))
+        for name, result in sorted(CUISINE_CALLS.items()):
+            if hasattr(cuisine, name):
+                self._patch(cuisine, name, self._cuisine_call(name, result))
+        for module in (fabric.api, fabric.operations, recipe_template,
+                       transport):
+            self._patch(module, 'put', self._put)
+        for module in (fabric.api, fabric.operations, recipe_template,
+                       connections):
+            self._patch(module, 'local', self._local)
+        self._patch(connections, 'connections', _FakeConnections())
+
+    def uninstall(self):
+        '''
+        Put the real calls back.
+        '''
+        while self.saved:
+            obj, name, value = self.saved.pop()
+            setattr(obj, name, value)
+
+    def __enter__(self):
+        self.install()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.uninstall()
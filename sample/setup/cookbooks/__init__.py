@@ -1,7 +1,6 @@
-from base import CookbookBase
-from web import CookbookWeb
-
+# cookbook classes are named as 'module.ClassName' so that frycooker.py
+# only imports the cookbooks it's going to use
 cookbooks = {
-    'base': CookbookBase,
-    'web': CookbookWeb
+    'base': 'base.CookbookBase',
+    'web': 'web.CookbookWeb'
     }
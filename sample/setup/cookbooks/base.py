@@ -1,11 +1,11 @@
 from frycook import Cookbook
 
-from recipes import RecipeHosts
-from recipes import RecipeRootUser
-from recipes import RecipeShorewall
-from recipes import RecipeSSH
-from recipes import RecipeFail2ban
-from recipes import RecipePostfix
+from recipes.hosts import RecipeHosts
+from recipes.root_user import RecipeRootUser
+from recipes.shorewall import RecipeShorewall
+from recipes.ssh import RecipeSSH
+from recipes.fail2ban import RecipeFail2ban
+from recipes.postfix import RecipePostfix
 
 
 class CookbookBase(Cookbook):
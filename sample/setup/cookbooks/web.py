@@ -1,7 +1,7 @@
 from frycook import Cookbook
 
-from recipes import RecipeNginx
-from recipes import RecipeExampleCom
+from recipes.nginx import RecipeNginx
+from recipes.example_com import RecipeExampleCom
 
 
 class CookbookWeb(Cookbook):
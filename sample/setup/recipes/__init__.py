@@ -1,19 +1,12 @@
-from fail2ban import RecipeFail2ban
-from hosts import RecipeHosts
-from nginx import RecipeNginx
-from postfix import RecipePostfix
-from root_user import RecipeRootUser
-from example_com import RecipeExampleCom
-from shorewall import RecipeShorewall
-from ssh import RecipeSSH
-
+# recipe classes are named as 'module.ClassName' so that frycooker.py
+# only imports the recipes it's going to use
 recipes = {
-    'fail2ban': RecipeFail2ban,
-    'hosts': RecipeHosts,
-    'nginx': RecipeNginx,
-    'postfix': RecipePostfix,
-    'root_user': RecipeRootUser,
-    'example_com': RecipeExampleCom,
-    'shorewall': RecipeShorewall,
-    'ssh': RecipeSSH
+    'fail2ban': 'fail2ban.RecipeFail2ban',
+    'hosts': 'hosts.RecipeHosts',
+    'nginx': 'nginx.RecipeNginx',
+    'postfix': 'postfix.RecipePostfix',
+    'root_user': 'root_user.RecipeRootUser',
+    'example_com': 'example_com.RecipeExampleCom',
+    'shorewall': 'shorewall.RecipeShorewall',
+    'ssh': 'ssh.RecipeSSH'
     }
@@ -4,6 +4,10 @@ from frycook import Recipe, RecipeException
 
 
 class RecipeExampleCom(Recipe):
+    requires = ['RecipeNginx']
+    remote_paths = ['/etc/nginx/sites-enabled/example_com']
+    push_packages = ['example_com']
+
     def __init__(self, settings, environment, ok_to_be_rude, no_prompt):
         super(RecipeExampleCom, self).__init__(
             settings, environment, ok_to_be_rude, no_prompt)
@@ -19,9 +23,10 @@ class RecipeExampleCom(Recipe):
 
     def apply(self, computer):
         username = "example_com"
-        if not cuisine.user_check(username):
+        if not self.facts.has_user(username):
             cuisine.user_create(username)
             cuisine.sudo('usermod -p `openssl rand -base64 32` %s' % username)
+            self.facts.add_user(username)
 
         key = self.environment["users"][username]["ssh_public_key"]
         cuisine.ssh_authorize(username, key)
@@ -31,9 +36,11 @@ class RecipeExampleCom(Recipe):
         cuisine.file_link('/home/example_com/www',
                           '/srv/www/example_com')
 
-        self.push_package_file_set('example_com', computer)
-
-        cuisine.file_link('/etc/nginx/sites-available/example_com',
-                          '/etc/nginx/sites-enabled/example_com')
+        self.push_package_file_set('example_com', computer,
+                                   notify='service nginx restart')
 
-        cuisine.sudo("service nginx restart")
+        if not self.facts.path_exists('/etc/nginx/sites-enabled/example_com'):
+            cuisine.file_link('/etc/nginx/sites-available/example_com',
+                              '/etc/nginx/sites-enabled/example_com')
+            self.facts.forget_path('/etc/nginx/sites-enabled/example_com')
+            self.notify('service nginx restart')
@@ -1,8 +1,6 @@
-import cuisine
-
 from frycook import Recipe
 
 
 class RecipeFail2ban(Recipe):
-    def apply(self, computer):
-        cuisine.package_ensure('fail2ban')
+    packages = ['fail2ban']
+    requires = []
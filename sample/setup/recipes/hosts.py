@@ -1,16 +1,20 @@
-import cuisine
-
 from frycook import Recipe
 
 
 class RecipeHosts(Recipe):
-    def apply(self, computer):
+    push_packages = ['hosts']
+
+    def hosts_env(self, computer):
         group = self.environment["computers"][computer]["host_group"]
-        computers = self.environment["groups"][group]["computers"]
-        sibs = [comp for comp in computers if comp != computer]
-        tmp_env = {"host": computer,
-                   "sibs": sibs,
-                   "computers": self.environment["computers"]}
-        self.push_package_file_set('hosts', computer, tmp_env)
+        return {"host": computer,
+                "sibs": self.environment.siblings(computer, group),
+                "computers": self.environment["computers"]}
 
-        cuisine.sudo("service hostname restart")
+    def prerender_packages(self, computer):
+        # hosts.tmplt loops over every computer in the group, so it's
+        # worth rendering ahead of time for big groups
+        return [('hosts', self.hosts_env(computer))]
+
+    def apply(self, computer):
+        self.push_package_file_set('hosts', computer, self.hosts_env(computer),
+                                   notify='service hostname restart')
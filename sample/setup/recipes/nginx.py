@@ -8,12 +8,12 @@ class RecipeNginx(Recipe):
     Let's serve all the files from the /srv/www directory
     instead of the default /usr/share/nginx/www.
     '''
-    def apply(self, computer):
-        cuisine.package_ensure('nginx-extras')
+    packages = ['nginx-extras']
+    push_packages = ['nginx']
 
+    def apply(self, computer):
         cuisine.dir_ensure('/srv/www/', mode='755')
 
         tmp_env = {"name": computer}
-        self.push_package_file_set('nginx', computer, tmp_env)
-
-        cuisine.sudo("service nginx restart")
+        self.push_package_file_set('nginx', computer, tmp_env,
+                                   notify='service nginx restart')
@@ -1,19 +1,16 @@
-import cuisine
-from fabric.context_managers import prefix
-
 from frycook import Recipe
 
 
 class RecipePostfix(Recipe):
-    def apply(self, computer):
-        with prefix('export DEBIAN_FRONTEND=noninteractive'):
-            cuisine.package_ensure('postfix')
-            cuisine.package_ensure('mailutils')
+    # packages are installed with debconf in noninteractive mode
+    packages = ['postfix', 'mailutils']
+    push_packages = ['postfix']
+    requires = []
 
+    def apply(self, computer):
         tmp_env = {"name": computer}
         if "name" in self.settings["params"]:
             tmp_env["name"] = self.settings["params"]["name"]
-        self.push_package_file_set('postfix', computer, tmp_env)
-
-        cuisine.sudo("/usr/bin/newaliases")
-        cuisine.sudo("service postfix restart")
+        self.push_package_file_set(
+            'postfix', computer, tmp_env,
+            notify=['/usr/bin/newaliases', 'service postfix restart'])
@@ -13,7 +13,9 @@ class RecipeRootUser(Recipe):
 
     def apply(self, computer):
         username = "root"
-        cuisine.user_ensure(username)
+        if not self.facts.has_user(username):
+            cuisine.user_create(username)
+            self.facts.add_user(username)
 
         key = self.environment["users"][username]["ssh_public_key"]
         cuisine.ssh_authorize(username, key)
@@ -1,13 +1,10 @@
-import cuisine
-
 from frycook import Recipe
 
 
 class RecipeShorewall(Recipe):
-    def apply(self, computer):
-        cuisine.package_ensure('shorewall')
-        cuisine.package_ensure('shorewall-doc')
+    packages = ['shorewall', 'shorewall-doc']
+    push_packages = ['shorewall']
 
-        self.push_package_file_set('shorewall', computer)
-
-        cuisine.sudo("service shorewall restart")
+    def apply(self, computer):
+        self.push_package_file_set('shorewall', computer,
+                                   notify='service shorewall restart')
@@ -0,0 +1,218 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Frycook opens one connection to each host and keeps it for the whole
+run.  Along with fabric's own connection, it starts an OpenSSH control
+master for the host, so that rsync, git, and anything else that runs
+ssh locally can multiplex over an already open connection instead of
+setting up a new one each time.
+'''
+import atexit
+import os
+import os.path
+import pipes
+import shutil
+import tempfile
+import time
+
+from fabric.api import env, hide, local
+from fabric.api import settings as fab_settings
+from fabric.network import disconnect_all, normalize
+from fabric.state import connections
+
+import timing
+
+# seconds spent setting up connections, by host name:
+# (fabric connection, ssh control master or None if there isn't one)
+_connect_times = {}
+
+# directory holding the control master sockets for this process
+_control_dir = []
+
+
+def get_control_dir():
+    '''
+    Get the directory that holds the control master sockets for this
+    process, creating it the first time.  It's kept short because unix
+    socket paths have a small length limit.
+
+    :rtype: string
+    :return: path to the directory
+    '''
+    if not _control_dir:
+        _control_dir.append(tempfile.mkdtemp(prefix='fck-ssh-'))
+        atexit.register(shutil.rmtree, _control_dir[0], True)
+    return _control_dir[0]
+
+
+def get_ssh_command(control_master='no'):
+    '''
+    Get an ssh command line that uses the current host's control master
+    if there is one, suitable for passing to rsync's -e option or as
+    GIT_SSH_COMMAND.  If the control master isn't running, ssh just makes
+    its own connection.  Connect as the user fabric connects as, so the
+    control master is found; see get_ssh_destination().
+
+    :type control_master: string
+    :param control_master: value for ssh's ControlMaster option; "yes" to
+                           start a control master.  ssh keeps the first
+                           value it's given for an option, so this can't be
+                           overridden by adding another -o later on.
+
+    :rtype: string
+    :return: ssh command line
+    '''
+    command = ['ssh', '-o', 'ControlMaster=%s' % control_master, '-o',
+               'ControlPath=%s' % os.path.join(get_control_dir(), '%r@%h:%p')]
+    if env.key_filename:
+        keys = env.key_filename
+        if isinstance(keys, basestring):
+            keys = [keys]
+        for key in keys:
+            command.extend(['-i', key])
+    return ' '.join([pipes.quote(part) for part in command])
+
+
+def get_ssh_destination(host=None):
+    '''
+    Get the user@hostname and port that fabric connects to for a host,
+    which are the ones its control master is opened for.
+
+    :type host: string
+    :param host: host string; the one fabric is currently pointed at if
+                 it's None
+
+    :rtype: tuple of (string, string)
+    :return: (user@hostname, port)
+    '''
+    user, hostname, port = normalize(host or env.host_string)
+    return '%s@%s' % (user, hostname), port
+
+
+def connect():
+    '''
+    Connect to the host fabric is currently pointed at, if this process
+    isn't already connected to it, and start a control master for it.
+    The time taken by each is recorded.
+    '''
+    host = env.host_string
+    if host in _connect_times:
+        return
+
+    start = time.time()
+    connections[host]
+    fabric_time = time.time() - start
+    timing.record('connect', 'fabric', start, fabric_time)
+
+    destination, port = get_ssh_destination(host)
+    start = time.time()
+    with fab_settings(hide('everything'), warn_only=True):
+        result = local('%s -o BatchMode=yes -p %s -fN %s'
+                       % (get_ssh_command('yes'), port,
+                          pipes.quote(destination)))
+        if result.succeeded:
+            # only count the master if its socket is really there
+            result = local('%s -p %s -O check %s'
+                           % (get_ssh_command(), port,
+                              pipes.quote(destination)))
+    if result.succeeded:
+        master_time = time.time() - start
+        timing.record('connect', 'ssh control master', start, master_time)
+    else:
+        master_time = None
+    _connect_times[host] = (fabric_time, master_time)
+
+
+def exit_control_masters(host):
+    '''
+    Stop any control masters for a host that were left running by a
+    worker process that was killed before it could disconnect.  They're
+    found by their sockets in the control directory, whatever user they
+    were opened as, so this works from the parent process as long as it
+    created the control directory before forking the worker.
+
+    :type host: string
+    :param host: host string the worker was pointed at
+    '''
+    user, hostname, port = normalize(host)
+    suffix = '@%s:%s' % (hostname, port)
+    control_dir = get_control_dir()
+    for name in os.listdir(control_dir):
+        if not name.endswith(suffix):
+            continue
+        path = os.path.join(control_dir, name)
+        with fab_settings(hide('everything'), warn_only=True):
+            local('ssh -o ControlPath=%s -O exit %s' %
+                  (pipes.quote(path), pipes.quote(hostname)))
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _close(host):
+    '''
+    Close the control master and fabric connection for one host, and
+    print how long they took to set up.
+
+    :type host: string
+    :param host: host string the connection was opened for
+    '''
+    destination, port = get_ssh_destination(host)
+    fabric_time, master_time = _connect_times.pop(host)
+    if master_time is not None:
+        start = time.time()
+        with fab_settings(hide('everything'), warn_only=True):
+            local('%s -p %s -O exit %s' %
+                  (get_ssh_command(), port, pipes.quote(destination)))
+        timing.record('disconnect', 'ssh control master', start,
+                      time.time() - start, host)
+        print "connection setup for %s: %.2fs, ssh control master: " \
+            "%.2fs" % (host, fabric_time, master_time)
+    else:
+        print "connection setup for %s: %.2fs, no ssh control master" % (
+            host, fabric_time)
+    if host in connections:
+        connections[host].close()
+        del connections[host]
+
+
+def disconnect(host=None):
+    '''
+    Close the connections and control masters opened by this process,
+    and print how long they took to set up.
+
+    :type host: string
+    :param host: only close the connections to this host; all of them if
+                 it's None
+    '''
+    if host is not None:
+        if host in _connect_times:
+            _close(host)
+        return
+    for host in sorted(_connect_times):
+        _close(host)
+    disconnect_all()
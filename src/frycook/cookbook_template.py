@@ -29,6 +29,7 @@
 Cookbooks are sets of recipes to apply to a server to create systems made up of
 subsystems.
 '''
+from packages import install_packages, unique_packages
 
 
 class Cookbook(object):
@@ -78,6 +79,48 @@ class Cookbook(object):
             self.recipes.append(
                 recipe(settings, environment, ok_to_be_rude, no_prompt))
 
+    @property
+    def remote_paths(self):
+        '''
+        The remote paths that the recipes in recipe_list check, so they
+        can be gathered up front with the rest of the facts.
+
+        :rtype: list of strings
+        :return: remote paths for all the recipes
+        '''
+        paths = []
+        for recipe in self.recipes:
+            paths.extend(recipe.remote_paths)
+        return paths
+
+    @property
+    def push_packages(self):
+        '''
+        The packages that the recipes in recipe_list push with
+        push_package_file_set(), so the directories in them can be
+        gathered up front with the rest of the facts.
+
+        :rtype: list of strings
+        :return: package names for all the recipes
+        '''
+        packages = []
+        for recipe in self.recipes:
+            packages.extend(recipe.push_packages)
+        return packages
+
+    @property
+    def packages(self):
+        '''
+        The os-level packages that the recipes in recipe_list need.
+
+        :rtype: list of strings
+        :return: package names for all the recipes
+        '''
+        packages = []
+        for recipe in self.recipes:
+            packages.extend(recipe.packages)
+        return unique_packages(packages)
+
     #######################
     ######## APPLY ########
     #######################
@@ -125,15 +168,47 @@ class Cookbook(object):
         for recipe in self.recipes:
             recipe.apply(computer)
 
+    def prerender_packages(self, computer):
+        '''
+        List the packages the recipes in recipe_list will push to a
+        computer, so their templates can be rendered ahead of time.  See
+        Recipe.prerender_packages().
+
+        :type computer: string
+        :param computer: name of computer the cookbook will be applied to
+
+        :rtype: list of tuples of (string, dict)
+        :return: (package name, aux_env or None) for each package
+        '''
+        packages = []
+        for recipe in self.recipes:
+            packages.extend(recipe.prerender_packages(computer))
+        return packages
+
+    def health_check(self, computer):
+        '''
+        Run the health_check functions for all the recipes defined in
+        recipe_list.  Override this if there's something you need to check
+        above and beyond the recipe-level checks.  Be sure to call the base
+        class if you override this.
+
+        :type computer: string
+        :param computer: name of computer to check
+        '''
+        for recipe in self.recipes:
+            recipe.health_check(computer)
+
     def run_apply(self, computer):
         '''
-        Run the apply process for the computer.  This is usually just called
-        from frycooker.
+        Run the apply process for the computer.  The packages for all the
+        recipes are installed together after the checks and before any
+        recipe is applied.  This is usually just called from frycooker.
 
         :type computer: string
         :param computer: name of computer to apply recipe to
         '''
         self.pre_apply_checks(computer)
+        install_packages(self.packages)
         self.apply(computer)
 
     def run_messages(self):
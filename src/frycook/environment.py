@@ -0,0 +1,151 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+The environment is loaded once at the start of a run and then only read,
+so frycooker indexes it as soon as it's loaded.  An Environment is the
+environment dictionary itself, with indexes of which groups each
+computer is in, which computers are in each group, and which computer
+has each ip address and hostname.  Recipes get it as self.environment,
+and templates pushed with push_package_file_set() get it as
+"environment".
+'''
+
+
+class Environment(dict):
+    '''
+    The environment dictionary, along with indexes for looking things up
+    in it without scanning it.  The indexes are built when it's created;
+    call reindex() after changing its computers or groups.
+    '''
+    def __init__(self, *args, **kwargs):
+        '''
+        Takes the same arguments as dict().
+        '''
+        dict.__init__(self, *args, **kwargs)
+        self.reindex()
+
+    def reindex(self):
+        '''
+        Build the indexes from the computers and groups in the environment.
+        '''
+        self.computer_groups = {}
+        self.group_members = {}
+        self.group_member_sets = {}
+        self.ip_computers = {}
+        self.hostname_computers = {}
+        computers = self.get("computers", {})
+        for name in computers:
+            self.computer_groups[name] = []
+        for group in sorted(self.get("groups", {})):
+            members = self["groups"][group].get("computers", [])
+            self.group_members[group] = list(members)
+            self.group_member_sets[group] = set(members)
+            for name in members:
+                self.computer_groups.setdefault(name, []).append(group)
+        for name in sorted(computers):
+            for key in ("public_ips", "private_ips"):
+                for ip, hostname in computers[name].get(key, {}).iteritems():
+                    self.ip_computers.setdefault(ip, name)
+                    self.hostname_computers.setdefault(hostname, name)
+
+    def groups_of(self, computer):
+        '''
+        Get the groups a computer is in.
+
+        :type computer: string
+        :param computer: name of the computer
+
+        :rtype: list of strings
+        :return: names of the groups, sorted
+        '''
+        return self.computer_groups.get(computer, [])
+
+    def members(self, group):
+        '''
+        Get the computers in a group.
+
+        :type group: string
+        :param group: name of the group
+
+        :rtype: list of strings
+        :return: names of the computers, in the order the group lists them
+        '''
+        return self.group_members.get(group, [])
+
+    def in_group(self, computer, group):
+        '''
+        Check if a computer is in a group.
+
+        :type computer: string
+        :param computer: name of the computer
+        :type group: string
+        :param group: name of the group
+
+        :rtype: boolean
+        :return: True if the computer is in the group
+        '''
+        return computer in self.group_member_sets.get(group, ())
+
+    def siblings(self, computer, group):
+        '''
+        Get the other computers in a group.
+
+        :type computer: string
+        :param computer: name of the computer
+        :type group: string
+        :param group: name of the group
+
+        :rtype: list of strings
+        :return: names of the computers in the group besides computer
+        '''
+        return [name for name in self.members(group) if name != computer]
+
+    def computer_for_ip(self, ip):
+        '''
+        Find the computer with an ip address, public or private.
+
+        :type ip: string
+        :param ip: ip address
+
+        :rtype: string
+        :return: name of the computer, or None if no computer has it
+        '''
+        return self.ip_computers.get(ip)
+
+    def computer_for_hostname(self, hostname):
+        '''
+        Find the computer with a hostname.  If more than one computer has
+        it, the one whose name sorts first is returned.
+
+        :type hostname: string
+        :param hostname: hostname from a computer's public_ips or private_ips
+
+        :rtype: string
+        :return: name of the computer, or None if no computer has it
+        '''
+        return self.hostname_computers.get(hostname)
@@ -0,0 +1,263 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+The executor runs a function for each of a list of jobs, each in a
+process of its own, with a limit on how many run at once and on how long
+each one can take.  Frycooker uses it to apply to many hosts at once.
+Every host gets a freshly forked process, so it starts from the state
+frycooker had before the apply, and a host that hangs can be killed
+without losing any other host's work.
+'''
+import multiprocessing
+import os
+import select
+import signal
+import time
+import traceback
+
+# seconds a timed out process gets to clean up before it's killed
+TERMINATE_GRACE = 10
+
+# longest the executor waits between checks on workers it has told to
+# stop
+STOP_POLL = 0.5
+
+# set in a worker process once it has been told to stop
+_terminated = []
+
+
+def _handle_term(signum, frame):
+    '''
+    Turn the signal that stops a timed out worker into an exception, so
+    that the worker's cleanup code gets to run.
+    '''
+    _terminated.append(signum)
+    raise SystemExit("timed out")
+
+
+def _run_job(func, job, conn):
+    '''
+    Run one job in a worker process and send its result back.
+
+    :type func: function
+    :param func: function to call with the job
+    :type job: anything
+    :param job: job to run
+    :type conn: multiprocessing.Connection
+    :param conn: connection to send the result over
+    '''
+    signal.signal(signal.SIGTERM, _handle_term)
+    try:
+        result = (func(job), None)
+    except (Exception, SystemExit), e:
+        traceback.print_exc()
+        result = (None, "%s: %s" % (e.__class__.__name__, e))
+    if not _terminated:
+        conn.send(result)
+    conn.close()
+
+
+class ProcessExecutor(object):
+    '''
+    Runs a function for each job in its own worker process.  Jobs and the
+    state they need are handed to the workers by forking, so they don't
+    have to be picklable, but results are sent back and do.
+    '''
+    def __init__(self, func, max_workers, timeout=None, cleanup=None):
+        '''
+        :type func: function
+        :param func: function to call with each job
+        :type max_workers: int
+        :param max_workers: most worker processes to run at once
+        :type timeout: float
+        :param timeout: seconds each job can take before its worker is stopped, or None for no limit
+        :type cleanup: function
+        :param cleanup: function to call with a job, in this process, once its worker has been stopped or has died without a result, to clean up anything the worker left behind; or None
+        '''
+        self.func = func
+        self.max_workers = max(1, max_workers)
+        self.timeout = timeout
+        self.cleanup = cleanup
+        self.running = {}
+        # workers told to stop: (job, process, time to kill it)
+        self.stopping = []
+
+    def _start(self, job):
+        '''
+        Start a worker process for a job.
+
+        :type job: anything
+        :param job: job to run
+        '''
+        reader, writer = multiprocessing.Pipe(False)
+        process = multiprocessing.Process(target=_run_job,
+                                          args=(self.func, job, writer))
+        process.daemon = True
+        process.start()
+        writer.close()
+        self.running[reader.fileno()] = (job, process, reader, time.time())
+
+    def _clean_up(self, job):
+        '''
+        Run the cleanup function for a job whose worker didn't finish.
+
+        :type job: anything
+        :param job: job the worker was running
+        '''
+        if self.cleanup is None:
+            return
+        try:
+            self.cleanup(job)
+        except Exception:
+            traceback.print_exc()
+
+    def _finish(self, fileno):
+        '''
+        Collect the result of a worker that has sent one or exited.
+
+        :type fileno: int
+        :param fileno: file descriptor of the worker's connection
+
+        :rtype: tuple of (anything, anything, string)
+        :return: (job, result, error message or None)
+        '''
+        job, process, reader, start = self.running.pop(fileno)
+        try:
+            result, error = reader.recv()
+            died = False
+        except EOFError:
+            result = None
+            error = "worker process exited without a result"
+            died = True
+        reader.close()
+        process.join()
+        if died:
+            self._clean_up(job)
+        return job, result, error
+
+    def _stop(self, fileno):
+        '''
+        Tell a worker that has run out of time to stop.  It gets
+        TERMINATE_GRACE seconds to clean up before it's killed; that's
+        left to _reap(), so results from the other workers can still be
+        collected in the meantime.
+
+        :type fileno: int
+        :param fileno: file descriptor of the worker's connection
+
+        :rtype: tuple of (anything, anything, string)
+        :return: (job, None, error message)
+        '''
+        job, process, reader, start = self.running.pop(fileno)
+        process.terminate()
+        reader.close()
+        self.stopping.append((job, process, time.time() + TERMINATE_GRACE))
+        return job, None, "timed out after %ss" % self.timeout
+
+    def _reap(self, wait=False):
+        '''
+        Deal with workers that have been told to stop: collect the ones
+        that have exited, and kill the ones that are out of grace time.
+        A worker that had to be killed didn't get to clean up after
+        itself, so the cleanup function is run for it.
+
+        :type wait: bool
+        :param wait: whether to wait until every one of them is gone
+        '''
+        while self.stopping:
+            now = time.time()
+            for item in list(self.stopping):
+                job, process, kill_at = item
+                if process.is_alive() and now < kill_at:
+                    continue
+                self.stopping.remove(item)
+                if process.is_alive():
+                    os.kill(process.pid, signal.SIGKILL)
+                    process.join()
+                    self._clean_up(job)
+                else:
+                    process.join()
+            if not wait or not self.stopping:
+                return
+            time.sleep(min(STOP_POLL, max(0, min(
+                [kill_at for job, process, kill_at in self.stopping]) -
+                time.time())))
+
+    def _wait_time(self):
+        '''
+        Get how long to wait for a result before some worker runs out of
+        time, or it's time to check on the workers being stopped.
+
+        :rtype: float
+        :return: seconds to wait, or None to wait as long as it takes
+        '''
+        times = []
+        if self.timeout is not None and self.running:
+            first = min([start for job, process, reader, start
+                         in self.running.values()])
+            times.append(first + self.timeout - time.time())
+        if self.stopping:
+            times.append(STOP_POLL)
+        if not times:
+            return None
+        return max(0, min(times))
+
+    def run(self, jobs):
+        '''
+        Run all the jobs, up to max_workers at once.  A job whose worker
+        raises, dies, or runs out of time gets an error message instead of
+        a result.
+
+        :type jobs: list
+        :param jobs: jobs to run, in the order to start them
+
+        :rtype: iterator of tuples of (anything, anything, string)
+        :return: (job, result or None, error message or None), in the
+                 order the jobs finish
+        '''
+        pending = list(jobs)
+        pending.reverse()
+        try:
+            while pending or self.running or self.stopping:
+                while pending and len(self.running) < self.max_workers:
+                    self._start(pending.pop())
+                ready = select.select(self.running.keys(), [], [],
+                                      self._wait_time())[0]
+                for fileno in ready:
+                    yield self._finish(fileno)
+                if self.timeout is not None:
+                    now = time.time()
+                    for fileno, (job, process, reader, start) in \
+                            self.running.items():
+                        if now - start >= self.timeout:
+                            yield self._stop(fileno)
+                self._reap()
+        finally:
+            for fileno in self.running.keys():
+                self._stop(fileno)
+            self._reap(wait=True)
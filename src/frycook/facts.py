@@ -0,0 +1,316 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Facts are what frycook knows about the current state of a remote host:
+which packages are installed, which users and groups exist, and what is
+at the paths the run list cares about.  They are gathered with a single
+remote command at the start of each host's apply, so that recipes can
+make their idempotency checks with local lookups instead of a remote
+command per check.
+'''
+import pipes
+import threading
+
+import cuisine
+from fabric.api import env, hide
+
+# facts for the hosts handled by this process, by host name
+_facts = {}
+
+
+class Facts(object):
+    '''
+    A Facts object holds the facts gathered from one host.  The package
+    cache age is how many seconds ago the package manager's cache was
+    last updated, or None if that isn't known.  Paths that
+    weren't gathered up front are looked up on the host the first time
+    they're asked about and remembered after that.
+
+    Facts are a snapshot, so a recipe that changes something on the host
+    should tell the Facts object about it (add_package(), add_user(),
+    add_group(), forget_path()) so later checks see the change.
+    '''
+
+    def __init__(self):
+        '''
+        Start with no facts at all.
+        '''
+        self.packages = set()
+        self.users = set()
+        self.groups = set()
+        self.package_cache_age = None
+        self.paths = {}
+        self.lock = threading.Lock()
+
+    def gather(self, paths=()):
+        '''
+        Gather the installed packages, users, groups, and the given paths
+        from the host in one remote command.
+
+        :type paths: list of strings
+        :param paths: remote paths to look up
+        '''
+        sections = self._run_script(
+            "echo '@@packages'; "
+            "dpkg-query -W -f='${Status} ${Package}\\n' 2>/dev/null | "
+            "sed -n 's/^install ok installed //p'; "
+            "echo '@@users'; getent passwd | cut -d: -f1; "
+            "echo '@@groups'; getent group | cut -d: -f1; "
+            "echo '@@package_cache_age'; "
+            "t=$(stat -c %Y /var/lib/apt/lists 2>/dev/null) && "
+            "echo $(($(date +%s) - t)); "
+            + self._stat_script(paths))
+        self.packages = set(sections.get('packages', []))
+        self.users = set(sections.get('users', []))
+        self.groups = set(sections.get('groups', []))
+        for line in sections.get('package_cache_age', []):
+            try:
+                self.package_cache_age = int(line)
+            except ValueError:
+                pass
+        self._parse_stats(paths, sections.get('paths', []))
+
+    def _stat_script(self, paths):
+        '''
+        Build the part of a remote script that looks up paths.
+
+        :type paths: list of strings
+        :param paths: remote paths to look up
+
+        :rtype: string
+        :return: shell commands
+        '''
+        script = "echo '@@paths'; "
+        if paths:
+            script += ("stat -L -c '%%F|%%U|%%G|%%a|%%n' %s 2>/dev/null; " %
+                       ' '.join([pipes.quote(p) for p in paths]))
+        return script + "true"
+
+    def _run_script(self, script):
+        '''
+        Run a fact gathering script on the host and split its output into
+        sections.  Each section starts with a line containing '@@' and the
+        section name.
+
+        :type script: string
+        :param script: shell commands to run
+
+        :rtype: dict
+        :return: section name -> list of lines in the section
+        '''
+        with hide('running', 'stdout'):
+            output = cuisine.run(script)
+        sections = {}
+        lines = None
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('@@'):
+                lines = sections.setdefault(line[2:], [])
+            elif line and lines is not None:
+                lines.append(line)
+        return sections
+
+    def _parse_stats(self, paths, lines):
+        '''
+        Record the output of the stat commands from a fact gathering
+        script.  Paths that were asked about but didn't show up in the
+        output don't exist.
+
+        :type paths: list of strings
+        :param paths: remote paths that were looked up
+        :type lines: list of strings
+        :param lines: output of the stat commands
+        '''
+        with self.lock:
+            for path in paths:
+                self.paths[path] = None
+            for line in lines:
+                parts = line.split('|', 4)
+                if len(parts) == 5:
+                    self.paths[parts[4]] = tuple(parts[:4])
+
+    def stat(self, path):
+        '''
+        Get the type, owner, group, and permissions of a remote path,
+        following symlinks.  The type is what stat prints, ie. 'directory'
+        or 'regular file'.
+
+        :type path: string
+        :param path: remote path
+
+        :rtype: tuple of strings
+        :return: (<type>, <owner>, <group>, <perms>), or None if the path doesn't exist
+        '''
+        with self.lock:
+            if path in self.paths:
+                return self.paths[path]
+        sections = self._run_script(self._stat_script([path]))
+        self._parse_stats([path], sections.get('paths', []))
+        return self.paths[path]
+
+    def path_exists(self, path):
+        '''
+        Check if a path exists on the host.
+
+        :type path: string
+        :param path: remote path
+
+        :rtype: boolean
+        :return: True if the path exists on the host
+        '''
+        return self.stat(path) is not None
+
+    def is_dir(self, path):
+        '''
+        Check if a path is a directory on the host.
+
+        :type path: string
+        :param path: remote path
+
+        :rtype: boolean
+        :return: True if the path is a directory on the host
+        '''
+        info = self.stat(path)
+        return info is not None and info[0] == 'directory'
+
+    def is_file(self, path):
+        '''
+        Check if a path is a regular file on the host.
+
+        :type path: string
+        :param path: remote path
+
+        :rtype: boolean
+        :return: True if the path is a regular file on the host
+        '''
+        info = self.stat(path)
+        return info is not None and info[0].endswith('regular file')
+
+    def forget_path(self, path):
+        '''
+        Forget what's known about a path, so the next check looks it up on
+        the host again.
+
+        :type path: string
+        :param path: remote path
+        '''
+        with self.lock:
+            self.paths.pop(path, None)
+
+    def has_package(self, name):
+        '''
+        Check if a package is installed on the host.
+
+        :type name: string
+        :param name: package name
+
+        :rtype: boolean
+        :return: True if the package is installed on the host
+        '''
+        return name in self.packages
+
+    def add_package(self, name):
+        '''
+        Note that a package has been installed on the host.
+
+        :type name: string
+        :param name: package name
+        '''
+        self.packages.add(name)
+
+    def has_user(self, name):
+        '''
+        Check if a user exists on the host.
+
+        :type name: string
+        :param name: user name
+
+        :rtype: boolean
+        :return: True if the user exists on the host
+        '''
+        return name in self.users
+
+    def add_user(self, name):
+        '''
+        Note that a user has been created on the host.
+
+        :type name: string
+        :param name: user name
+        '''
+        self.users.add(name)
+
+    def has_group(self, name):
+        '''
+        Check if a group exists on the host.
+
+        :type name: string
+        :param name: group name
+
+        :rtype: boolean
+        :return: True if the group exists on the host
+        '''
+        return name in self.groups
+
+    def add_group(self, name):
+        '''
+        Note that a group has been created on the host.
+
+        :type name: string
+        :param name: group name
+        '''
+        self.groups.add(name)
+
+
+def gather_facts(paths=()):
+    '''
+    Gather facts from the host fabric is currently pointed at, replacing
+    any facts already gathered from it.
+
+    :type paths: list of strings
+    :param paths: remote paths to look up along with the other facts
+
+    :rtype: Facts
+    :return: facts for the current host
+    '''
+    facts = Facts()
+    facts.gather(paths)
+    _facts[env.host_string] = facts
+    return facts
+
+
+def get_facts():
+    '''
+    Get the facts for the host fabric is currently pointed at, gathering
+    them first if that hasn't been done yet.
+
+    :rtype: Facts
+    :return: facts for the current host
+    '''
+    if env.host_string not in _facts:
+        return gather_facts()
+    return _facts[env.host_string]
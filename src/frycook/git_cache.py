@@ -0,0 +1,237 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Frycook keeps a bare mirror of every git repo that recipes push, in its
+local cache directory.  Each mirror is fetched at most once per run, no
+matter how many computers the repo is pushed to, and each commit that's
+pushed is exported from the mirror into a working tree once and then
+copied from there to every computer.  The mirrors and working trees are
+kept between runs, so later runs only fetch what's new.  Only the most
+recently used working trees of each repo are kept, as many as the
+"git_trees_kept" setting says (default KEEP_TREES), plus any used by
+the current run.
+
+Worker processes of a parallel apply share the cache, so each mirror is
+locked while it's being fetched from or exported.
+'''
+import fcntl
+import hashlib
+import os
+import os.path
+import pipes
+import shutil
+import tempfile
+import threading
+
+from fabric.api import hide, local
+
+from local_cache import get_cache_dir
+
+# how many working trees to keep for each repo, if the "git_trees_kept"
+# setting doesn't say
+KEEP_TREES = 5
+
+# mirrors fetched by this process
+_fetched = set()
+
+# mirrors whose old working trees this process has pruned
+_pruned = set()
+_git_lock = threading.Lock()
+
+
+class _MirrorLock(object):
+    '''
+    Lock a mirror against other threads and processes.
+    '''
+
+    def __init__(self, mirror):
+        self.filename = mirror + '.lock'
+
+    def __enter__(self):
+        _git_lock.acquire()
+        try:
+            self.lockfile = open(self.filename, 'a')
+            fcntl.flock(self.lockfile, fcntl.LOCK_EX)
+        except:
+            _git_lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            fcntl.flock(self.lockfile, fcntl.LOCK_UN)
+            self.lockfile.close()
+        finally:
+            _git_lock.release()
+
+
+def get_mirror_path(settings, git_url):
+    '''
+    Get the path to the mirror for a git repo in the cache directory.
+
+    :type settings: dict
+    :param settings: settings dictionary
+    :type git_url: string
+    :param git_url: git url of repo
+
+    :rtype: string
+    :return: path to the bare mirror
+    '''
+    return os.path.join(get_cache_dir(settings, 'git'),
+                        hashlib.sha1(git_url).hexdigest() + '.git')
+
+
+def _update_mirror(settings, git_url, mirror):
+    '''
+    Create the mirror for a git repo, or fetch it if it hasn't already
+    been fetched this run.  A run is identified by the "run_id" setting,
+    which frycooker.py sets; without it each process fetches once.  The
+    caller must hold the mirror's lock.
+
+    :type settings: dict
+    :param settings: settings dictionary
+    :type git_url: string
+    :param git_url: git url of repo
+    :type mirror: string
+    :param mirror: path to the bare mirror
+    '''
+    if mirror in _fetched:
+        return
+    run_id = settings.get("run_id")
+    stamp = mirror + '.run_id'
+    if not os.path.exists(mirror):
+        tmp_mirror = '%s.%d.tmp' % (mirror, os.getpid())
+        shutil.rmtree(tmp_mirror, ignore_errors=True)
+        local('git clone --quiet --mirror %s %s' %
+              (pipes.quote(git_url), pipes.quote(tmp_mirror)))
+        os.rename(tmp_mirror, mirror)
+    elif run_id is None or not os.path.exists(stamp) or \
+            open(stamp).read() != run_id:
+        local('git --git-dir=%s fetch --quiet --prune origin' %
+              pipes.quote(mirror))
+    else:
+        # already fetched this run; leave the stamp's mtime alone, it
+        # marks when the run started using the mirror
+        _fetched.add(mirror)
+        return
+    if run_id is not None:
+        f = open(stamp, 'w')
+        try:
+            f.write(run_id)
+        finally:
+            f.close()
+    _fetched.add(mirror)
+
+
+def _prune_trees(settings, mirror, trees):
+    '''
+    Delete the working trees of a repo that haven't been used recently,
+    keeping the "git_trees_kept" most recently used ones and any used
+    since the mirror was fetched this run, along with leftovers of
+    exports that were interrupted.  This is done once per process for
+    each mirror.  The caller must hold the mirror's lock.
+
+    :type settings: dict
+    :param settings: settings dictionary
+    :type mirror: string
+    :param mirror: path to the bare mirror
+    :type trees: string
+    :param trees: directory holding the working trees
+    '''
+    if mirror in _pruned:
+        return
+    _pruned.add(mirror)
+    keep = settings.get("git_trees_kept", KEEP_TREES)
+    stamp = mirror + '.run_id'
+    if settings.get("run_id") is not None and os.path.exists(stamp):
+        run_start = os.path.getmtime(stamp)
+    else:
+        run_start = None
+    used = []
+    for name in os.listdir(trees):
+        path = os.path.join(trees, name)
+        if len(name) == 40 and os.path.isdir(path):
+            used.append((os.path.getmtime(path), path))
+        elif os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            os.remove(path)
+    used.sort(reverse=True)
+    for mtime, path in used[keep:]:
+        if run_start is None or mtime < run_start:
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def get_checkout(settings, git_url, ref='HEAD'):
+    '''
+    Get a working tree of a git repo at a ref, fetching the repo's
+    mirror first if it hasn't been fetched yet this run.  Working trees
+    are exported with git archive, so they don't have a .git directory,
+    and are kept by commit, so every push of the same commit shares one.
+
+    :type settings: dict
+    :param settings: settings dictionary
+    :type git_url: string
+    :param git_url: git url of repo
+    :type ref: string
+    :param ref: branch, tag, or commit to check out
+
+    :rtype: tuple of (string, string)
+    :return: (path to the working tree, commit SHA it's at)
+    '''
+    mirror = get_mirror_path(settings, git_url)
+    with _MirrorLock(mirror):
+        _update_mirror(settings, git_url, mirror)
+        with hide('running'):
+            sha = local('git --git-dir=%s rev-parse --verify %s' %
+                        (pipes.quote(mirror),
+                         pipes.quote(ref + '^{commit}')),
+                        capture=True).strip()
+        tree = os.path.join(mirror[:-len('.git')] + '.trees', sha)
+        if not os.path.exists(tree):
+            if not os.path.exists(os.path.dirname(tree)):
+                os.makedirs(os.path.dirname(tree))
+            tmp_tree = tempfile.mkdtemp(dir=os.path.dirname(tree))
+            os.chmod(tmp_tree, 0755)
+            archive = tmp_tree + '.tar'
+            try:
+                local('git --git-dir=%s archive --output=%s %s && '
+                      'tar -xf %s -C %s' %
+                      (pipes.quote(mirror), pipes.quote(archive), sha,
+                       pipes.quote(archive), pipes.quote(tmp_tree)))
+                os.rename(tmp_tree, tree)
+            except:
+                shutil.rmtree(tmp_tree, ignore_errors=True)
+                raise
+            finally:
+                if os.path.exists(archive):
+                    os.remove(archive)
+        else:
+            # the mtime records when the tree was last used, for pruning
+            os.utime(tree, None)
+        _prune_trees(settings, mirror, os.path.dirname(tree))
+    return tree, sha
@@ -0,0 +1,98 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Handlers are commands, like restarting a service, that only need to run
+if something they depend on changed.  Recipes notify handlers when they
+change things on a host, and frycooker runs each distinct handler once,
+in the order they were first notified, after the host's whole run list
+has been applied.
+'''
+import threading
+
+import cuisine
+from fabric.api import env
+
+# notified handlers for the hosts handled by this process, by host name
+_handlers = {}
+_handlers_lock = threading.Lock()
+
+
+def notify(handlers):
+    '''
+    Queue handlers to run on the host fabric is currently pointed at.
+    Handlers that are already queued aren't queued again.
+
+    :type handlers: string or list of strings
+    :param handlers: shell commands to run as handlers
+    '''
+    if isinstance(handlers, basestring):
+        handlers = [handlers]
+    with _handlers_lock:
+        queued = _handlers.setdefault(env.host_string, [])
+        for handler in handlers:
+            if handler not in queued:
+                queued.append(handler)
+
+
+def pending_handlers():
+    '''
+    Get the handlers queued for the host fabric is currently pointed at.
+
+    :rtype: list of strings
+    :return: shell commands queued to run
+    '''
+    with _handlers_lock:
+        return list(_handlers.get(env.host_string, []))
+
+
+def clear_handlers():
+    '''
+    Throw away the handlers queued for the host fabric is currently
+    pointed at without running them.
+
+    :rtype: list of strings
+    :return: shell commands that were queued
+    '''
+    with _handlers_lock:
+        return _handlers.pop(env.host_string, [])
+
+
+def run_handlers():
+    '''
+    Run the handlers queued for the host fabric is currently pointed at,
+    once each, in the order they were first notified.
+
+    :rtype: list of strings
+    :return: shell commands that were run
+    '''
+    handlers = pending_handlers()
+    for handler in handlers:
+        cuisine.sudo(handler)
+        with _handlers_lock:
+            _handlers[env.host_string].remove(handler)
+    return handlers
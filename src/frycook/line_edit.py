@@ -0,0 +1,193 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Line edits change a remote file a line at a time without copying it
+back and forth.  Any number of edits to one file are queued up, then
+done in a single pass by awk on the remote computer, and the file is
+only rewritten if its contents actually changed.  The strings and
+patterns for the edits are handed to awk through environment variables,
+so they never have to be escaped for awk and the file's contents never
+come back over the connection.
+'''
+import pipes
+
+import cuisine
+from fabric.api import hide
+
+from handlers import notify as notify_handlers
+
+# awk function for replacing plain text, since gsub() only does regexes
+_AWK_REPLACE = ('function fck_replace(s, old, new,    r, i) {'
+                ' r = "";'
+                ' while (old != "" && (i = index(s, old)) > 0) {'
+                ' r = r substr(s, 1, i - 1) new;'
+                ' s = substr(s, i + length(old)) }'
+                ' return r s }')
+
+
+class LineEditor(object):
+    '''
+    A LineEditor queues up line edits for one remote file and applies
+    them all with one remote command.  Edits are applied to each line in
+    the order they were queued.  Matches are on plain text unless regex
+    is True, in which case they're POSIX extended regular expressions as
+    understood by awk, and "&" in a replacement stands for the matched
+    text.
+
+    Example::
+
+      LineEditor('/etc/default/nginx') \\
+          .replace('ULIMIT=', '#ULIMIT=') \\
+          .append_line('ULIMIT=', 'ULIMIT="-n 8192"') \\
+          .apply()
+    '''
+
+    def __init__(self, filepath):
+        '''
+        Start with no edits.
+
+        :type filepath: string
+        :param filepath: fully-qualified path to remote file
+        '''
+        self.filepath = filepath
+        self.edits = []
+
+    def replace(self, old_text, new_text, regex=False):
+        '''
+        Queue up replacing text everywhere it appears in the file.
+
+        :type old_text: string
+        :param old_text: text or pattern to replace
+        :type new_text: string
+        :param new_text: text to replace with
+        :type regex: boolean
+        :param regex: old_text is a regular expression
+
+        :rtype: LineEditor
+        :return: this editor, so calls can be chained
+        '''
+        self.edits.append(('replace', old_text, new_text, regex))
+        return self
+
+    def delete_lines(self, match, regex=False):
+        '''
+        Queue up deleting every line that contains the text or matches the
+        pattern.
+
+        :type match: string
+        :param match: text or pattern to look for
+        :type regex: boolean
+        :param regex: match is a regular expression
+
+        :rtype: LineEditor
+        :return: this editor, so calls can be chained
+        '''
+        self.edits.append(('delete', match, None, regex))
+        return self
+
+    def append_line(self, match, line, regex=False):
+        '''
+        Queue up appending a line to the end of the file, unless a line
+        containing the text or matching the pattern is already there once
+        the edits before this one have been done.
+
+        :type match: string
+        :param match: text or pattern that shows the line is already there
+        :type line: string
+        :param line: line to append to the file
+        :type regex: boolean
+        :param regex: match is a regular expression
+
+        :rtype: LineEditor
+        :return: this editor, so calls can be chained
+        '''
+        self.edits.append(('append', match, line, regex))
+        return self
+
+    def get_command(self):
+        '''
+        Build the remote command that applies the queued edits.  It prints
+        "@@changed" if it changed the file.
+
+        :rtype: string
+        :return: shell command
+        '''
+        variables = []
+        body = []
+        end = []
+        for i, (action, match, text, regex) in enumerate(self.edits):
+            match_var = 'ENVIRON["FCK_M%d"]' % i
+            text_var = 'ENVIRON["FCK_T%d"]' % i
+            variables.append('FCK_M%d=%s' % (i, pipes.quote(match)))
+            if text is not None:
+                variables.append('FCK_T%d=%s' % (i, pipes.quote(text)))
+            if regex:
+                test = '$0 ~ %s' % match_var
+            else:
+                test = 'index($0, %s)' % match_var
+            if action == 'replace' and regex:
+                body.append('gsub(%s, %s);' % (match_var, text_var))
+            elif action == 'replace':
+                body.append('$0 = fck_replace($0, %s, %s);' %
+                            (match_var, text_var))
+            elif action == 'delete':
+                body.append('if (%s) next;' % test)
+            elif action == 'append':
+                body.append('if (%s) found%d = 1;' % (test, i))
+                end.append('if (!found%d) print %s;' % (i, text_var))
+        script = '%s { %s print } END { %s }' % (
+            _AWK_REPLACE, ' '.join(body), ' '.join(end))
+        return ('f=%(file)s; t=$(mktemp) && '
+                '%(vars)s awk %(script)s "$f" > "$t" && '
+                'if cmp -s "$f" "$t"; then rm -f "$t"; '
+                'else cat "$t" > "$f" && rm -f "$t" && echo @@changed; fi' %
+                {"file": pipes.quote(self.filepath),
+                 "vars": ' '.join(variables),
+                 "script": pipes.quote(script)})
+
+    def apply(self, notify=None):
+        '''
+        Apply the queued edits to the remote file with one remote command.
+        The file is only written if the edits change it, and it keeps its
+        owner, group, and permissions.
+
+        :type notify: string or list of strings
+        :param notify: handlers to notify if the file changed
+
+        :rtype: boolean
+        :return: True if the file changed
+        '''
+        if not self.edits:
+            return False
+        with hide('running', 'stdout'):
+            output = cuisine.run(self.get_command())
+        self.edits = []
+        changed = '@@changed' in output
+        if changed and notify:
+            notify_handlers(notify)
+        return changed
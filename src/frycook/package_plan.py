@@ -0,0 +1,480 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+A package plan is the list of file operations that pushing a package
+does: the directories to create, the files to upload, the templates to
+render, and the files to delete, with the owner, group, and permissions
+for each of them.  Working it out means walking the package directory
+and reading its fck_metadata.txt and fck_delete.txt files, none of which
+depends on the computer the package is pushed to, so the plan for each
+package is worked out once and shared by every recipe, thread, and
+computer that pushes it.  Plans only hold absolute paths and never
+change once they're built, so any number of threads can work through
+the same plan at once.
+
+The hashes of the package's regular files are worked out along with the
+plan, so the only per-computer work left is rendering the templates.
+With the "plan_cache" setting turned on, plans are also saved in
+frycook's cache directory and reused by later runs for as long as
+nothing in the package directory has changed.
+'''
+import collections
+import hashlib
+import json
+import os
+import os.path
+import pipes
+import re
+import stat
+import threading
+
+import cuisine
+
+from local_cache import get_cache_dir
+from push_cache import file_digest
+
+# actions for planned file operations
+DIRECTORY = 'dir'
+UPLOAD = 'upload'
+RENDER = 'render'
+DELETE = 'delete'
+
+# a planned file operation; local_path is the absolute path of the file
+# in the package (None for deletes), owner, group, and perms are None
+# when they're to be left alone, and digest is the hash of the file's
+# contents for uploads (None for everything else)
+FileOperation = collections.namedtuple(
+    'FileOperation', 'action remote_path local_path owner group perms digest')
+
+# wildcards in fck_delete.txt lines that the remote shell expands; the
+# brackets only allow plain characters so they can be left unquoted
+_wildcard_re = re.compile(r'(\*|\?|\[!?[\w.-]+\])')
+
+# plans by (packages directory, package name, file ignores pattern)
+_plans = {}
+_plans_lock = threading.Lock()
+
+
+def get_local_file_perms(local_name):
+    '''
+    Get a string of the permissions set on a local file.
+
+    :type local_name: string
+    :param local_name: path to file on local file system
+
+    :rtype: string
+    :return: string containing perms of file, ie. '655'
+    '''
+    bit_mode = stat.S_IMODE(os.stat(local_name).st_mode)
+    user_perms = (bit_mode & stat.S_IRWXU) >> 6
+    group_perms = (bit_mode & stat.S_IRWXG) >> 3
+    other_perms = bit_mode & stat.S_IRWXO
+    string_perms = "%s%s%s" % (user_perms, group_perms, other_perms)
+    return string_perms
+
+
+def is_pattern(path):
+    '''
+    Check if a remote path to delete is a glob pattern.
+
+    :type path: string
+    :param path: remote path from a fck_delete.txt file
+
+    :rtype: boolean
+    :return: True if the path has wildcards in it
+    '''
+    return _wildcard_re.search(path) is not None
+
+
+def quote_pattern(path):
+    '''
+    Quote a remote path for the shell, leaving any wildcards in it
+    unquoted so that the remote shell expands them.
+
+    :type path: string
+    :param path: remote path or glob pattern
+
+    :rtype: string
+    :return: quoted path
+    '''
+    parts = _wildcard_re.split(path)
+    return ''.join([part if i % 2 else pipes.quote(part)
+                    for i, part in enumerate(parts) if part])
+
+
+def delete_command(paths):
+    '''
+    Build one shell command that deletes a list of remote files, with
+    glob patterns expanded by the remote shell.  Paths that don't exist,
+    patterns that don't match anything, and directories are skipped.  It
+    prints a line starting with '@@deleted' for each file it deletes.
+
+    :type paths: list of strings
+    :param paths: remote paths and glob patterns of files to delete
+
+    :rtype: string
+    :return: shell command, or an empty string if there are no paths
+    '''
+    commands = []
+    # keep each command line to a reasonable length
+    for i in range(0, len(paths), 100):
+        commands.append(
+            'for f in %s; do if [ -f "$f" ] || [ -L "$f" ]; then '
+            'rm -f "$f"; echo "@@deleted $f"; fi; done' %
+            ' '.join([quote_pattern(path) for path in paths[i:i + 100]]))
+    return '\n'.join(commands)
+
+
+class FileMetaDataTracker(object):
+    '''
+    A FileMetaDataTracker object keeps track of owner, group, and
+    permissions for files and directories during a push_package_fileset
+    operation.  This hinges on a file named fck_metadata.txt being
+    encountered in the directory being examined.  This file should have
+    each line contain the text <filename>:<owner>:<group>:<perms>, where
+    <filename> is either a file name or '.' for the directory itself,
+    <owner> is the owner's account name, <group> is the group's name,
+    and <perms> is the permissions string..
+    '''
+
+    tagfile = 'fck_metadata.txt'
+
+    def __init__(self):
+        '''
+        Start with a blank metadata dictionary.
+        '''
+        self.metadata = {}
+
+    def check_directory(self, root, dirs, files):
+        '''
+        Read in the metadata for the given directory from the
+        fck_metadata.txt file in the directory, or remember metadata
+        from previous calls if no fck_metadata.txt file is encountered.
+
+        The input parameters are expected to be the values returned from
+        a call to os.walk()
+
+        :type root: string
+        :param root: directory being examined
+        :type dirs: list of strings
+        :param dirs: list of sub-directories under the root directory
+        :type files: list of strings
+        :param files: list of the files in the root directory
+        '''
+        if root not in self.metadata:
+            self.metadata[root] = (None, None, None, )
+
+        if self.tagfile in files:
+            for line in open(os.path.join(root, self.tagfile)):
+                parts = line.split(':')
+                path = parts[0].strip()
+                if len(path) > 0 and path[0] != '#':
+                    owner = parts[1].strip()
+                    group = parts[2].strip()
+                    if len(parts) > 3:
+                        perms = parts[3].strip()
+                    else:
+                        perms = None
+
+                    if path == '.':
+                        self.metadata[root] = (owner, group, perms, )
+                        for dn in dirs:
+                            self.metadata[os.path.join(root, dn)] = (
+                                owner, group, perms, )
+                    else:
+                        self.metadata[os.path.join(root, path)] = (
+                            owner, group, perms, )
+
+    def get_metadata(self, path, filename=''):
+        '''
+        Lookup the owner, group, and permissions for the given path and
+        filename from the metadata dictionary in this object.  If no
+        filename is specified, the data is retrieved for the directory
+        specified in path.
+
+        :type path: string
+        :param path: path to file to get metadata for
+        :type filename: string
+        :param filename: name of file to get metadata for (leave blank if just getting directory metadata)
+
+        :rtype: tuple of strings
+        :return: tuple containing (<owner>, <group>, <perms>, )
+        '''
+        fq = os.path.join(path, filename)
+        if fq in self.metadata:
+            return self.metadata[fq]
+        elif path in self.metadata:
+            return self.metadata[path]
+        else:
+            return None, None, None
+
+
+class FileDeleter(object):
+    '''
+    A FileDeleter object deletes unwanted files from a directory on a
+    remote server.  This hinges on a file named fck_delete.txt being
+    encountered in the directory being examined.  This file should have
+    each line contain the name of a file to be deleted, or a glob
+    pattern like *.dpkg-old for the files to be deleted.
+    '''
+
+    tagfile = 'fck_delete.txt'
+
+    def check_directory(self, root, files, remote_rootpath):
+        '''
+        Examine the given directory, check for a fck_delete.txt file in
+        the directory, and if it exists delete all remote files named in
+        it with one remote command.
+
+        :type root: string
+        :param root: local directory possibly containing fck_delete.txt
+        :type files: list of strings
+        :param files: list of the files in the local root directory
+        :type remote_rootpath: string
+        :param remote_rootpath: path on remote server to delete files from
+        '''
+
+        deletes = self.get_deletes(root, files, remote_rootpath)
+        if deletes:
+            cuisine.run(delete_command(deletes))
+
+    def get_deletes(self, root, files, remote_rootpath):
+        '''
+        Examine the given directory, check for a fck_delete.txt file in
+        the directory, and if it exists return the remote paths of all
+        the files named in it.
+
+        :type root: string
+        :param root: local directory possibly containing fck_delete.txt
+        :type files: list of strings
+        :param files: list of the files in the local root directory
+        :type remote_rootpath: string
+        :param remote_rootpath: path on remote server to delete files from
+
+        :rtype: list of strings
+        :return: remote paths of files to delete
+        '''
+        deletes = []
+        if self.tagfile in files:
+            for line in open(os.path.join(root, self.tagfile)):
+                if line.strip():
+                    deletes.append(
+                        os.path.join(remote_rootpath, line.strip()))
+        return deletes
+
+
+class PackagePlan(object):
+    '''
+    The file operations for pushing one package, in the order they should
+    be done: each directory comes before the files in it, followed by the
+    deletes for that directory.  Iterating over a plan yields
+    FileOperation tuples.
+
+    The operations are also split into the ones that are the same for
+    every computer (static) and the templates that have to be rendered
+    for each computer (templates).
+    '''
+
+    def __init__(self, package_dir, package_name, file_ignores,
+                 operations=None):
+        '''
+        Walk the package directory and plan its file operations, unless
+        the operations are given.
+
+        :type package_dir: string
+        :param package_dir: root of the packages hierarchy
+        :type package_name: string
+        :param package_name: name of package to plan, corresponds to directory in packages directory
+        :type file_ignores: string
+        :param file_ignores: regex pattern for filenames to leave out
+        :type operations: list of FileOperation tuples
+        :param operations: previously planned operations for the package
+        '''
+        self.package_dir = os.path.abspath(package_dir)
+        self.package_name = package_name
+        self.work_dir = os.path.join(self.package_dir, package_name)
+        if operations is None:
+            operations = self._walk(file_ignores)
+        self.operations = tuple(operations)
+        self.static = tuple(
+            [op for op in self.operations if op.action != RENDER])
+        self.templates = tuple(
+            [op for op in self.operations if op.action == RENDER])
+
+    def __iter__(self):
+        return iter(self.operations)
+
+    def __len__(self):
+        return len(self.operations)
+
+    def _walk(self, file_ignores):
+        '''
+        Generate the file operations for the package directory.
+
+        :type file_ignores: string
+        :param file_ignores: regex pattern for filenames to leave out
+
+        :rtype: iterator of FileOperation tuples
+        :return: planned file operations
+        '''
+        metadata = FileMetaDataTracker()
+        deleter = FileDeleter()
+        ignores = re.compile(file_ignores)
+        for root, dirs, files in os.walk(self.work_dir):
+            dirs.sort()
+            files.sort()
+            metadata.check_directory(root, dirs, files)
+            remote_root = os.path.normpath(
+                os.path.join('/', os.path.relpath(root, self.work_dir)))
+            owner, group, perms = metadata.get_metadata(root)
+            yield FileOperation(DIRECTORY, remote_root, root,
+                                owner, group, perms, None)
+            for filename in files:
+                if (ignores.search(filename) is not None
+                        or filename == metadata.tagfile
+                        or filename == deleter.tagfile):
+                    continue
+                local_name = os.path.join(root, filename)
+                owner, group, perms = metadata.get_metadata(root, filename)
+                if not perms:
+                    perms = get_local_file_perms(local_name)
+                base_name, ext = os.path.splitext(filename)
+                if ext == '.tmplt':
+                    yield FileOperation(
+                        RENDER, os.path.join(remote_root, base_name),
+                        local_name, owner, group, perms, None)
+                else:
+                    yield FileOperation(
+                        UPLOAD, os.path.join(remote_root, filename),
+                        local_name, owner, group, perms,
+                        file_digest(local_name))
+            for delfile in deleter.get_deletes(root, files, remote_root):
+                yield FileOperation(DELETE, delfile, None,
+                                    None, None, None, None)
+
+    def template_name(self, operation):
+        '''
+        Get the name to look up a template with, relative to the packages
+        directory.
+
+        :type operation: FileOperation
+        :param operation: RENDER operation from this plan
+
+        :rtype: string
+        :return: path of the template within the packages directory
+        '''
+        return os.path.relpath(operation.local_path, self.package_dir)
+
+
+def get_package_signature(work_dir):
+    '''
+    Get a signature of everything in a package directory that a plan
+    depends on: the path, modification time, and size of every directory
+    and file in it.  Directory modification times alone would miss files
+    that are edited in place.
+
+    :type work_dir: string
+    :param work_dir: package directory
+
+    :rtype: list of lists
+    :return: [path, mtime, size] for each directory and file, in walk order
+    '''
+    signature = []
+    for root, dirs, files in os.walk(work_dir):
+        dirs.sort()
+        files.sort()
+        for name in [''] + files:
+            path = os.path.join(root, name)
+            info = os.stat(path)
+            signature.append([path, info.st_mtime, info.st_size])
+    return signature
+
+
+def _load_plan(settings, key):
+    '''
+    Get the plan for a package from the plan cache if it's still good, or
+    work it out and save it in the plan cache.
+
+    :type settings: dict
+    :param settings: settings dictionary
+    :type key: tuple of (string, string, string)
+    :param key: (packages directory, package name, file ignores pattern)
+
+    :rtype: PackagePlan
+    :return: plan for the package
+    '''
+    filename = os.path.join(get_cache_dir(settings, 'plans'),
+                            hashlib.sha1(repr(key)).hexdigest() + '.json')
+    signature = get_package_signature(os.path.join(key[0], key[1]))
+    try:
+        f = open(filename)
+        try:
+            cached = json.load(f)
+        finally:
+            f.close()
+        if cached["signature"] == signature:
+            return PackagePlan(*key, operations=[
+                FileOperation(*op) for op in cached["operations"]])
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    plan = PackagePlan(*key)
+    tmp_name = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmp_name, 'w')
+    try:
+        json.dump({"signature": signature,
+                   "operations": plan.operations}, f)
+    finally:
+        f.close()
+    os.rename(tmp_name, filename)
+    return plan
+
+
+def get_package_plan(settings, package_name):
+    '''
+    Get the plan for pushing a package, working it out, or loading it
+    from the plan cache if the "plan_cache" setting is on, the first time
+    it's asked for.
+
+    :type settings: dict
+    :param settings: settings dictionary
+    :type package_name: string
+    :param package_name: name of package, corresponds to directory in packages directory
+
+    :rtype: PackagePlan
+    :return: plan for the package
+    '''
+    key = (os.path.abspath(settings["package_dir"]), package_name,
+           settings["file_ignores"])
+    with _plans_lock:
+        if key not in _plans:
+            if settings.get("plan_cache"):
+                _plans[key] = _load_plan(settings, key)
+            else:
+                _plans[key] = PackagePlan(*key)
+        return _plans[key]
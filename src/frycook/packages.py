@@ -0,0 +1,98 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Recipes list the os-level packages they need in their packages class
+variable, and frycook installs them.  Frycooker.py installs the packages
+for a computer's whole run list in a single package manager transaction
+before any recipes are applied, and only installs the ones the facts
+say are missing.
+'''
+import cuisine
+
+from facts import get_facts
+
+
+def unique_packages(names):
+    '''
+    Remove duplicates from a list of package names, keeping the first
+    occurrence of each.
+
+    :type names: list of strings
+    :param names: package names
+
+    :rtype: list of strings
+    :return: package names without duplicates
+    '''
+    seen = set()
+    packages = []
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            packages.append(name)
+    return packages
+
+
+def install_packages(names):
+    '''
+    Install whichever of the named packages aren't installed on the
+    current computer yet, all in one call to cuisine's package_install(),
+    so cuisine still picks the package manager and its options.
+
+    :type names: list of strings
+    :param names: package names
+
+    :rtype: list of strings
+    :return: names of the packages that were installed
+    '''
+    facts = get_facts()
+    missing = [name for name in unique_packages(names)
+               if not facts.has_package(name)]
+    if missing:
+        cuisine.package_install(missing)
+        for name in missing:
+            facts.add_package(name)
+    return missing
+
+
+def update_packages(max_age=None):
+    '''
+    Update the package manager's cache on the current computer, unless
+    it was updated less than max_age seconds ago.
+
+    :type max_age: int
+    :param max_age: maximum age in seconds of a cache that doesn't need updating (None to always update)
+
+    :rtype: boolean
+    :return: True if the cache was updated
+    '''
+    if max_age:
+        age = get_facts().package_cache_age
+        if age is not None and age < max_age:
+            return False
+    cuisine.package_update()
+    return True
@@ -0,0 +1,207 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Pre-rendering renders the templates in the packages each computer's
+recipes will push, in a pool of worker processes, while frycooker is
+busy applying to the computers before it.  Recipes say what they'll push
+through prerender_packages().  When a recipe renders a template, the
+pre-rendered copy is used if it was rendered with an equal template
+environment; otherwise the template is rendered as usual.  Pre-rendering
+is used when computers are applied to one at a time and the
+"prerender_templates" setting is true.
+'''
+import collections
+import multiprocessing
+
+from fabric.api import env
+
+import package_plan
+from template_cache import get_template_lookup
+
+# rendered templates for the computers handled by this process, by
+# (host name, template name): (template environment, rendered template)
+_rendered = {}
+
+# how many computers' templates can be rendered ahead of the one being
+# applied to, per worker process; anything rendered but not yet applied
+# is held in memory
+LOOKAHEAD = 2
+
+# rendering jobs; set before the worker processes are forked, so they
+# inherit them instead of having them pickled
+_jobs = []
+
+
+def package_template_env(environment, computer, aux_env=None):
+    '''
+    Build the template environment for a package pushed to a computer.
+    See Recipe.push_package_file_set().
+
+    :type environment: dict
+    :param environment: environment dictionary
+    :type computer: string
+    :param computer: name of the computer
+    :type aux_env: dict
+    :param aux_env: additional key/value pairs for the template environment
+
+    :rtype: dict
+    :return: environment dictionary for the template engine
+    '''
+    template_env = {"computer": environment["computers"][computer],
+                    "environment": environment}
+    if aux_env is not None:
+        template_env.update(aux_env)
+    return template_env
+
+
+def get_rendered(templatename, enviro):
+    '''
+    Get a template pre-rendered for the host fabric is currently pointed
+    at.
+
+    :type templatename: string
+    :param templatename: path within packages dir of template file
+    :type enviro: dict
+    :param enviro: environment dictionary for template engine
+
+    :rtype: string
+    :return: rendered template, or None if it wasn't pre-rendered with an equal environment
+    '''
+    entry = _rendered.get((env.host_string, templatename))
+    if entry is not None and entry[0] == enviro:
+        return entry[1]
+    return None
+
+
+def _render_job(index):
+    '''
+    Render the templates for one computer in a worker process.  Packages
+    and templates that fail are left out; they're tried again when
+    they're pushed, and the error is reported then.
+
+    :type index: int
+    :param index: index of the job in _jobs
+
+    :rtype: tuple of (int, list)
+    :return: (index, list of (package index, template name, rendered template))
+    '''
+    host, settings, packages = _jobs[index]
+    lookup = get_template_lookup(settings)
+    rendered = []
+    for i, (package_name, template_env) in enumerate(packages):
+        try:
+            plan = package_plan.get_package_plan(settings, package_name)
+        except Exception:
+            continue
+        for op in plan:
+            if op.action != package_plan.RENDER:
+                continue
+            name = plan.template_name(op)
+            try:
+                buff = lookup.get_template(name).render(**template_env)
+            except Exception:
+                continue
+            rendered.append((i, name, buff))
+    return index, rendered
+
+
+class Prerenderer(object):
+    '''
+    Renders the templates for a list of computers in a pool of worker
+    processes, in the order they'll be applied to, and hands them over
+    one computer at a time.  Only LOOKAHEAD computers per worker are
+    rendered ahead of the one being waited for.
+    '''
+    def __init__(self, settings, jobs, processes=None):
+        '''
+        Start rendering.
+
+        :type settings: dict
+        :param settings: settings dictionary
+        :type jobs: list of tuples of (string, list)
+        :param jobs: (host name, list of (package name, template environment)), in the order the hosts will be applied to
+        :type processes: int
+        :param processes: number of worker processes, or None for one per cpu
+        '''
+        _jobs[:] = [(host, settings, packages) for host, packages in jobs]
+        self.indexes = dict([(job[0], i) for i, job in enumerate(jobs)])
+        self.next = 0
+        self.submitted = 0
+        self.window = LOOKAHEAD * (processes or multiprocessing.cpu_count())
+        self.pending = collections.deque()
+        self.pool = multiprocessing.Pool(processes)
+        self._submit()
+
+    def _submit(self):
+        '''
+        Hand the workers more computers to render, up to the lookahead
+        window.
+        '''
+        while (len(self.pending) < self.window and
+               self.submitted < len(_jobs)):
+            self.pending.append(self.pool.apply_async(_render_job,
+                                                      (self.submitted,)))
+            self.submitted += 1
+
+    def wait_for(self, host):
+        '''
+        Wait until the templates for a host have been rendered, and make
+        them available to its recipes.  Hosts have to be waited for in
+        the order they were given.
+
+        :type host: string
+        :param host: name of the host
+        '''
+        target = self.indexes.get(host)
+        while target is not None and self.next <= target:
+            index, rendered = self.pending.popleft().get()
+            self._submit()
+            job_host, settings, packages = _jobs[index]
+            for i, name, buff in rendered:
+                _rendered[(job_host, name)] = (packages[i][1], buff)
+            self.next = index + 1
+
+    def discard(self, host):
+        '''
+        Forget the templates rendered for a host once it's done.
+
+        :type host: string
+        :param host: name of the host
+        '''
+        for key in [key for key in _rendered if key[0] == host]:
+            del _rendered[key]
+
+    def close(self):
+        '''
+        Stop the worker processes.
+        '''
+        self.pool.terminate()
+        self.pool.join()
+        self.pending.clear()
+        _rendered.clear()
+        del _jobs[:]
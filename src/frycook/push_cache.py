@@ -0,0 +1,296 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+The push cache remembers what frycook last pushed to each host, so that
+files and directories that haven't changed since then can be skipped
+without any remote commands at all.
+'''
+import hashlib
+import json
+import os
+import os.path
+import pipes
+
+import cuisine
+from fabric.api import env, hide
+
+from local_cache import get_cache_dir
+
+# marker used in place of a content hash for directories and deleted files
+DIRECTORY = 'dir'
+DELETED = 'deleted'
+
+# push caches for the hosts handled by this process, by host name
+_push_caches = {}
+
+
+def file_digest(filename):
+    '''
+    Get the hash of a local file's contents, the same as sha1sum would.
+
+    :type filename: string
+    :param filename: path to local file
+
+    :rtype: string
+    :return: hex digest of the file's contents
+    '''
+    digest = hashlib.sha1()
+    f = open(filename, 'rb')
+    try:
+        for block in iter(lambda: f.read(65536), ''):
+            digest.update(block)
+    finally:
+        f.close()
+    return digest.hexdigest()
+
+
+def content_digest(content):
+    '''
+    Get the hash of a string, the same as sha1sum would for a file with
+    the string as its contents.
+
+    :type content: string
+    :param content: contents to hash (unicode is hashed as utf-8)
+
+    :rtype: string
+    :return: hex digest of the contents
+    '''
+    if isinstance(content, unicode):
+        content = content.encode('utf-8')
+    return hashlib.sha1(content).hexdigest()
+
+
+def normalize_perms(perms):
+    '''
+    Put a permissions string into the same form that stat prints, so
+    that '0644' and '644' compare equal.
+
+    :type perms: string
+    :param perms: permissions string, ie. '644'
+
+    :rtype: string
+    :return: normalized permissions string
+    '''
+    try:
+        return '%o' % int(perms, 8)
+    except (TypeError, ValueError):
+        return perms
+
+
+def remote_digests(paths, run=None):
+    '''
+    Get the hashes of the contents of files on the current host, all in
+    one remote command.
+
+    :type paths: list of strings
+    :param paths: remote paths
+    :type run: function
+    :param run: function that runs a remote command, cuisine.run if None
+
+    :rtype: dict
+    :return: path -> hex digest, or None for paths that aren't regular files
+    '''
+    if run is None:
+        run = cuisine.run
+    digests = dict([(path, None) for path in paths])
+    for i in range(0, len(paths), 500):
+        cmd = ("for f in %s; do [ -f \"$f\" ] && "
+               "echo \"$(sha1sum < \"$f\" | cut -c1-40) $f\"; done; true" %
+               ' '.join([pipes.quote(p) for p in paths[i:i + 500]]))
+        with hide('running', 'stdout'):
+            output = run(cmd)
+        for line in output.splitlines():
+            parts = line.strip().split(' ', 1)
+            if len(parts) == 2 and parts[1] in digests:
+                digests[parts[1]] = parts[0]
+    return digests
+
+
+class PushCache(object):
+    '''
+    A PushCache object is the manifest of everything frycook has pushed
+    to one host: for each remote path the hash of its contents, its
+    owner, group, and permissions.  The manifest is stored as a json file
+    in the local cache directory so it lasts from one run to the next.
+
+    Entries are only recorded after a push has succeeded.  If files
+    might have been changed on the host behind frycook's back, verify()
+    checks every entry against the host in a single remote command and
+    throws away the ones that no longer match.
+    '''
+
+    def __init__(self, filename):
+        '''
+        Load the manifest from its file, or start an empty one if the
+        file doesn't exist or can't be read.
+
+        :type filename: string
+        :param filename: path to the json file holding the manifest
+        '''
+        self.filename = filename
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(filename):
+            try:
+                self.entries = json.load(open(filename))
+            except ValueError:
+                self.entries = {}
+
+    def is_current(self, path, digest, owner, group, perms):
+        '''
+        Check if the host already has exactly this path as of the last
+        push.
+
+        :type path: string
+        :param path: remote path
+        :type digest: string
+        :param digest: hash of the contents to push, or DIRECTORY or DELETED
+        :type owner: string
+        :param owner: owner of the path
+        :type group: string
+        :param group: group of the path
+        :type perms: string
+        :param perms: permissions for the path, ie. '655'
+
+        :rtype: boolean
+        :return: True if the path can be skipped
+        '''
+        return self.entries.get(path) == [digest, owner, group,
+                                          normalize_perms(perms)]
+
+    def record(self, path, digest, owner=None, group=None, perms=None):
+        '''
+        Remember that the path was pushed successfully.
+
+        :type path: string
+        :param path: remote path
+        :type digest: string
+        :param digest: hash of the contents pushed, or DIRECTORY or DELETED
+        :type owner: string
+        :param owner: owner of the path
+        :type group: string
+        :param group: group of the path
+        :type perms: string
+        :param perms: permissions for the path, ie. '655'
+        '''
+        self.entries[path] = [digest, owner, group, normalize_perms(perms)]
+        self.dirty = True
+
+    def forget(self, path):
+        '''
+        Forget what was pushed to the path, so it will be pushed again.
+
+        :type path: string
+        :param path: remote path
+        '''
+        if self.entries.pop(path, None) is not None:
+            self.dirty = True
+
+    def save(self):
+        '''
+        Write the manifest back to its file if it has changed.
+        '''
+        if not self.dirty:
+            return
+        tmp_name = '%s.%d.tmp' % (self.filename, os.getpid())
+        f = open(tmp_name, 'w')
+        try:
+            json.dump(self.entries, f)
+        finally:
+            f.close()
+        os.rename(tmp_name, self.filename)
+        self.dirty = False
+
+    def verify(self):
+        '''
+        Check every entry in the manifest against the current host with
+        one remote command, and throw away entries for paths that have
+        been changed, deleted, or created since they were pushed.
+        '''
+        if not self.entries:
+            return
+        paths = sorted(self.entries)
+        remote = {}
+        for i in range(0, len(paths), 500):
+            cmd = ("for f in %s; do "
+                   "if [ -d \"$f\" ]; then h=%s; "
+                   "elif [ -f \"$f\" ]; then "
+                   "h=$(sha1sum < \"$f\" | cut -c1-40); "
+                   "else echo \"%s - - - $f\"; continue; fi; "
+                   "echo \"$h $(stat -c '%%U %%G %%a' \"$f\") $f\"; done" %
+                   (' '.join([pipes.quote(p) for p in paths[i:i + 500]]),
+                    DIRECTORY, DELETED))
+            with hide('running', 'stdout'):
+                output = cuisine.run(cmd)
+            for line in output.splitlines():
+                parts = line.strip().split(' ', 4)
+                if len(parts) == 5:
+                    remote[parts[4]] = parts[:4]
+
+        for path in paths:
+            digest, owner, group, perms = self.entries[path]
+            found = remote.get(path)
+            if (found is None or found[0] != digest or
+                    (digest != DELETED and
+                     ((owner and found[1] != owner) or
+                      (group and found[2] != group) or
+                      (perms and found[3] != perms)))):
+                self.forget(path)
+
+
+def get_push_cache(settings):
+    '''
+    Get the push cache for the host fabric is currently pointed at.  The
+    cache is loaded the first time it's asked for, and verified against
+    the host at that point if the "verify_push_cache" setting is true.
+
+    :type settings: dict
+    :param settings: settings dictionary
+
+    :rtype: PushCache
+    :return: push cache for the current host, or None if the "push_cache" setting isn't turned on
+    '''
+    if not settings.get("push_cache"):
+        return None
+    host = env.host_string
+    if host not in _push_caches:
+        filename = os.path.join(get_cache_dir(settings, 'push'),
+                                '%s.json' % host.replace(os.sep, '_'))
+        push_cache = PushCache(filename)
+        if settings.get("verify_push_cache"):
+            push_cache.verify()
+        _push_caches[host] = push_cache
+    return _push_caches[host]
+
+
+def save_push_caches():
+    '''
+    Save the push caches for all the hosts handled by this process.
+    '''
+    for push_cache in _push_caches.values():
+        push_cache.save()
@@ -31,15 +31,73 @@ They are the basic units of setup in frycook.  Generally a recipe
 corresponds to an os-level package that needs to be installed or
 configured.
 '''
+import functools
 import os
 import os.path
+import pipes
 import re
 import shutil
-import stat
+import StringIO
+import tarfile
+import tempfile
+import time
+import uuid
 
 import cuisine
-from fabric.api import local
-from mako.lookup import TemplateLookup
+from fabric.api import local, put
+
+from handlers import notify as notify_handlers
+from line_edit import LineEditor
+import package_plan
+import prerender
+import push_cache
+import timing
+from connections import get_ssh_command, get_ssh_destination
+from facts import get_facts
+from git_cache import get_checkout
+from package_plan import FileDeleter, FileMetaDataTracker  # noqa
+from packages import install_packages
+from template_cache import get_template_lookup
+from transport import get_transport
+
+# a full git commit SHA, which can be deployed without asking the origin
+_SHA_RE = re.compile(r'^[0-9a-f]{40}$')
+
+# remote script for Recipe.deploy_git_repo(); it finds the commit the ref
+# points to, and fetches and checks it out unless HEAD is already there
+_GIT_DEPLOY_SCRIPT = '''set -e
+url=%(url)s
+dir=%(dir)s
+ref=%(ref)s
+before=$(git --git-dir="$dir/.git" rev-parse -q --verify HEAD 2>/dev/null \\
+         || true)
+if %(is_sha)s; then
+    target=$ref
+else
+    target=$(git ls-remote "$url" "refs/heads/$ref" "refs/tags/$ref" \\
+             "refs/tags/$ref^{}" |
+             awk '/\\^\\{\\}$/ {p = $1} !f {f = $1} END {print p ? p : f}')
+    if [ -z "$target" ]; then
+        echo "no branch or tag named $ref in $url" >&2
+        exit 1
+    fi
+fi
+if [ "$before" != "$target" ]; then
+    depth=
+    if [ -z "$before" ] || [ -f "$dir/.git/shallow" ]; then
+        depth='%(depth)s'
+    fi
+    [ -d "$dir/.git" ] || git init -q "$dir"
+    cd "$dir"
+    git remote set-url origin "$url" 2>/dev/null || \\
+        git remote add origin "$url"
+    git fetch -q $depth origin "$target" 2>/dev/null || \\
+        git fetch -q $depth origin "$ref" 2>/dev/null || \\
+        git fetch -q origin
+    git checkout -q -f "$target"
+fi
+echo "@@deploy $before $target"
+'''
 
 
 class RecipeException(Exception):
@@ -50,120 +108,6 @@ class RecipeException(Exception):
     pass
 
 
-class FileMetaDataTracker(object):
-    '''
-    A FileMetaDataTracker object keeps track of owner, group, and
-    permissions for files and directories during a push_package_fileset
-    operation.  This hinges on a file named fck_metadata.txt being
-    encountered in the directory being examined.  This file should have
-    each line contain the text <filename>:<owner>:<group>:<perms>, where
-    <filename> is either a file name or '.' for the directory itself,
-    <owner> is the owner's account name, <group> is the group's name,
-    and <perms> is the permissions string..
-    '''
-
-    tagfile = 'fck_metadata.txt'
-
-    def __init__(self):
-        '''
-        Start with a blank metadata dictionary.
-        '''
-        self.metadata = {}
-
-    def check_directory(self, root, dirs, files):
-        '''
-        Read in the metadata for the given directory from the
-        fck_metadata.txt file in the directory, or remember metadata
-        from previous calls if no fck_metadata.txt file is encountered.
-
-        The input parameters are expected to be the values returned from
-        a call to os.walk()
-
-        :type root: string
-        :param root: directory being examined
-        :type dirs: list of strings
-        :param dirs: list of sub-directories under the root directory
-        :type files: list of strings
-        :param files: list of the files in the root directory
-        '''
-        if root not in self.metadata:
-            self.metadata[root] = (None, None, None, )
-
-        if self.tagfile in files:
-            for line in open(os.path.join(root, self.tagfile)):
-                parts = line.split(':')
-                path = parts[0].strip()
-                if len(path) > 0 and path[0] != '#':
-                    owner = parts[1].strip()
-                    group = parts[2].strip()
-                    if len(parts) > 3:
-                        perms = parts[3].strip()
-                    else:
-                        perms = None
-
-                    if path == '.':
-                        self.metadata[root] = (owner, group, perms, )
-                        for dn in dirs:
-                            self.metadata[os.path.join(root, dn)] = (
-                                owner, group, perms, )
-                    else:
-                        self.metadata[os.path.join(root, path)] = (
-                            owner, group, perms, )
-
-    def get_metadata(self, path, filename=''):
-        '''
-        Lookup the owner, group, and permissions for the given path and
-        filename from the metadata dictionary in this object.  If no
-        filename is specified, the data is retrieved for the directory
-        specified in path.
-
-        :type path: string
-        :param path: path to file to get metadata for
-        :type filename: string
-        :param filename: name of file to get metadata for (leave blank if just getting directory metadata)
-
-        :rtype: tuple of strings
-        :return: tuple containing (<owner>, <group>, <perms>, )
-        '''
-        fq = os.path.join(path, filename)
-        if fq in self.metadata:
-            return self.metadata[fq]
-        elif path in self.metadata:
-            return self.metadata[path]
-        else:
-            return None, None, None
-
-
-class FileDeleter(object):
-    '''
-    A FileDeleter object deletes unwanted files from a directory on a
-    remote server.  This hinges on a file named fck_delete.txt being
-    encountered in the directory being examined.  This file should have
-    each line contain the name of a file to be deleted.
-    '''
-
-    tagfile = 'fck_delete.txt'
-
-    def check_directory(self, root, files, remote_rootpath):
-        '''
-        Examine the given directory, check for a fck_delete.txt file in
-        the directory, and if it exists delete all remote files named in
-        it.
-
-        :type root: string
-        :param root: local directory possibly containing fck_delete.txt
-        :type files: list of strings
-        :param files: list of the files in the local root directory
-        :type remote_rootpath: string
-        :param remote_rootpath: path on remote server to delete files from
-        '''
-
-        if self.tagfile in files:
-            for line in open(os.path.join(root, self.tagfile)):
-                delfile = os.path.join(remote_rootpath, line.strip())
-                cuisine.file_unlink(delfile)
-
-
 class Recipe(object):
     '''
     The Recipe class is the base class for all recipes to subclass.  It
@@ -194,8 +138,37 @@ class Recipe(object):
         update_git_repo()
         is_git_repo()
         ensure_git_repo()
+
+    Recipes can check the state of the remote server through the facts
+    attribute, a Facts object gathered at the start of the apply.
+
+    Remote operations that can be put off, like creating directories and
+    setting permissions, can go through the transport attribute, which
+    batches them into one remote command if the "batch_commands"
+    setting is true.  See frycook.transport for details.  List
+    any remote paths the recipe will check in the remote_paths class
+    variable so they are gathered up front along with everything else,
+    and the packages it pushes with push_package_file_set() in the
+    push_packages class variable so the directories in them are too.
+
+    List the os-level packages the recipe needs in the packages class
+    variable.  They will be installed before apply() is called, together
+    with the packages for every other recipe being applied to the
+    computer.
+
+    Set the requires class variable to the list of names the recipe
+    depends on, so frycooker can apply it as soon as those are done
+    instead of strictly in run list order.  A recipe provides its class
+    name and any names in its provides class variable.  See
+    frycook.scheduler for details.
     '''
 
+    packages = []
+    remote_paths = []
+    push_packages = []
+    provides = []
+    requires = None
+
     def __init__(self, settings, environment, ok_to_be_rude, no_prompt):
         '''
         Initialize the recipe object with the settings and environment
@@ -210,8 +183,27 @@ class Recipe(object):
         self.environment = environment
         self.ok_to_be_rude = ok_to_be_rude
         self.no_prompt = no_prompt
-        self.mylookup = TemplateLookup(
-            directories=[self.settings["package_dir"]])
+        self.mylookup = get_template_lookup(self.settings)
+
+    @property
+    def facts(self):
+        '''
+        The facts for the computer currently being applied to.
+
+        :rtype: Facts
+        :return: facts for the current computer
+        '''
+        return get_facts()
+
+    @property
+    def transport(self):
+        '''
+        The transport for the computer currently being applied to.
+
+        :rtype: ImmediateTransport
+        :return: transport for the current computer
+        '''
+        return get_transport(self.settings)
 
     #######################
     ######## APPLY ########
@@ -280,6 +272,41 @@ class Recipe(object):
         '''
         pass
 
+    def prerender_packages(self, computer):
+        '''
+        List the packages apply() will push to a computer with
+        push_package_file_set(), along with the aux_env it'll pass for
+        each, so frycooker can render their templates ahead of time.  Only
+        list packages whose aux_env can be worked out before the apply
+        starts; if the aux_env at push time isn't equal to the one listed
+        here, the templates are just rendered then.  Override this
+        function in your subclass of Recipe if its templates are expensive
+        to render, for example if they loop over every computer in the
+        environment.
+
+        :type computer: string
+        :param computer: name of computer the recipe will be applied to
+
+        :rtype: list of tuples of (string, dict)
+        :return: (package name, aux_env or None) for each package
+        '''
+        return []
+
+    def health_check(self, computer):
+        '''
+        Check that the computer is healthy once the recipe has been applied
+        to it and its handlers have run, for example that the service the
+        recipe configures is up and answering.  frycooker uses this to stop
+        a rolling apply before a bad change reaches too many computers.
+        Override this function in your subclass of Recipe if there's
+        something worth checking.  Raise a RecipeException if the computer
+        isn't healthy.
+
+        :type computer: string
+        :param computer: name of computer to check
+        '''
+        pass
+
     def run_apply(self, computer):
         '''
         Run the apply sequence of functions.  This is typically called by
@@ -287,12 +314,13 @@ class Recipe(object):
 
         Sequence::
 
-          pre_apply_checks() -> apply()
+          pre_apply_checks() -> install packages -> apply()
 
         :type computer: string
         :param computer: name of computer to apply recipe to
         '''
         self.pre_apply_checks(computer)
+        install_packages(self.packages)
         self.apply(computer)
 
     def run_messages(self):
@@ -303,6 +331,23 @@ class Recipe(object):
         self.handle_pre_apply_message()
         self.handle_post_apply_message()
 
+    def notify(self, handlers):
+        '''
+        Queue handlers to run once the computer's whole run list has been
+        applied.  A handler is a shell command, like "service nginx
+        restart", that is run with sudo.  However many times a handler is
+        notified during a run it is only run once, so several recipes can
+        ask for the same service to be restarted without restarting it
+        several times.
+
+        The push functions take a notify argument that does this for you
+        when they actually change something.
+
+        :type handlers: string or list of strings
+        :param handlers: shell commands to run
+        '''
+        notify_handlers(handlers)
+
     ###############################
     ######## FILE HANDLING ########
     ###############################
@@ -317,14 +362,10 @@ class Recipe(object):
         :rtype: string
         :return: string containing perms of file, ie. '655'
         '''
-        bit_mode = stat.S_IMODE(os.stat(local_name).st_mode)
-        user_perms = (bit_mode & stat.S_IRWXU) >> 6
-        group_perms = (bit_mode & stat.S_IRWXG) >> 3
-        other_perms = bit_mode & stat.S_IRWXO
-        string_perms = "%s%s%s" % (user_perms, group_perms, other_perms)
-        return string_perms
+        return package_plan.get_local_file_perms(local_name)
 
-    def push_file(self, local_name, remote_name, owner, group, perms=None):
+    def push_file(self, local_name, remote_name, owner, group, perms=None,
+                  notify=None, digest=None):
         '''
         Copy a file to a remote server if the file is different or doesn't
         exist.
@@ -339,16 +380,65 @@ class Recipe(object):
         :param group: group of the file
         :type perms: string
         :param perms: permissions for the file, ie. '655'
+        :type notify: string or list of strings
+        :param notify: handlers to notify if the file's contents change
+        :type digest: string
+        :param digest: hash of the local file's contents, if already known
+
+        :rtype: boolean
+        :return: True if the file's contents changed
         '''
-        local_name = os.path.join(self.settings["package_dir"], local_name)
-        cuisine.file_upload(remote_name, local_name)
-        if not perms:
-            perms = self.get_local_file_perms(local_name)
-        cuisine.file_attribs(
-            remote_name, mode=perms, owner=owner, group=group)
+        transport = self.transport
+        with timing.timed('push_file', remote_name), transport.batch():
+            local_name = os.path.join(self.settings["package_dir"], local_name)
+            if not perms:
+                perms = self.get_local_file_perms(local_name)
+            if digest is None:
+                digest = push_cache.file_digest(local_name)
+            cache = push_cache.get_push_cache(self.settings)
+            if cache is not None and cache.is_current(remote_name, digest,
+                                                      owner, group, perms):
+                return False
+            remote_digest = push_cache.remote_digests(
+                [remote_name], transport.run)[remote_name]
+            changed = remote_digest != digest
+            if changed:
+                transport.file_upload(remote_name, local_name)
+            transport.file_attribs(
+                remote_name, mode=perms, owner=owner, group=group)
+            if cache is not None:
+                transport.after_flush(functools.partial(
+                    cache.record, remote_name, digest, owner, group, perms))
+            if changed and notify:
+                self.notify(notify)
+            return changed
+
+    def render_template(self, templatename, enviro):
+        '''
+        Process a template file and return its contents.  If frycooker
+        already rendered it with the same environment, that copy is used.
+
+        :type templatename: string
+        :param templatename: path within packages dir of template file to process (path + filename)
+        :type enviro: dict
+        :param enviro: environment dictionary for template engine
+
+        :rtype: string
+        :return: rendered template
+        :raises RecipeException: raised if the template fails to render
+        '''
+        buff = prerender.get_rendered(templatename, enviro)
+        if buff is not None:
+            return buff
+        mytemplate = self.mylookup.get_template(templatename)
+        try:
+            return mytemplate.render(**enviro)
+        except Exception, e:
+            raise RecipeException(
+                "Error rendering template %s: %s" % (templatename, e))
 
     def push_template(self, templatename, out_path, enviro,
-                      owner, group, perms=None):
+                      owner, group, perms=None, notify=None):
         '''
         Process a template file and push its contents to a remote server if
         it's different than what's already there.
@@ -365,19 +455,37 @@ class Recipe(object):
         :param group: group of the templated file
         :type perms: string
         :param perms: permissions for the templated file, ie. '655'
+        :type notify: string or list of strings
+        :param notify: handlers to notify if the file's contents change
+
+        :rtype: boolean
+        :return: True if the file's contents changed
         '''
-        mytemplate = self.mylookup.get_template(templatename)
-        try:
-            buff = mytemplate.render(**enviro)
-        except Exception, e:
-            raise RecipeException(
-                "Error rendering template %s: %s" % (templatename, e))
-        cuisine.file_write(out_path, buff, check=True)
-        local_name = os.path.join(self.settings["package_dir"], templatename)
-        if not perms:
-            perms = self.get_local_file_perms(local_name)
-        cuisine.file_attribs(
-            out_path, mode=perms, owner=owner, group=group)
+        transport = self.transport
+        with timing.timed('push_template', out_path), transport.batch():
+            buff = self.render_template(templatename, enviro)
+            local_name = os.path.join(self.settings["package_dir"],
+                                      templatename)
+            if not perms:
+                perms = self.get_local_file_perms(local_name)
+            digest = push_cache.content_digest(buff)
+            cache = push_cache.get_push_cache(self.settings)
+            if cache is not None and cache.is_current(out_path, digest,
+                                                      owner, group, perms):
+                return False
+            remote_digest = push_cache.remote_digests(
+                [out_path], transport.run)[out_path]
+            changed = remote_digest != digest
+            if changed:
+                transport.file_write(out_path, buff)
+            transport.file_attribs(
+                out_path, mode=perms, owner=owner, group=group)
+            if cache is not None:
+                transport.after_flush(functools.partial(
+                    cache.record, out_path, digest, owner, group, perms))
+            if changed and notify:
+                self.notify(notify)
+            return changed
 
     def _push_package_file_set(self, package_name, template_env):
         '''
@@ -389,36 +497,245 @@ class Recipe(object):
         :param package_name: name of package to process, corresponds to directory in packages directory
         :type template_env: dict
         :param template_env: environment dictionary for template engine
+
+        :rtype: boolean
+        :return: True if any file was changed or deleted
+        '''
+        plan = package_plan.get_package_plan(self.settings, package_name)
+        cache = push_cache.get_push_cache(self.settings)
+        changed = False
+        deletes = []
+        for op in plan:
+            if op.action == package_plan.DIRECTORY:
+                if cache is None or not cache.is_current(
+                        op.remote_path, push_cache.DIRECTORY,
+                        op.owner, op.group, op.perms):
+                    if (op.owner or op.group or op.perms or
+                            not self.facts.is_dir(op.remote_path)):
+                        self.transport.dir_ensure(
+                            op.remote_path, owner=op.owner, group=op.group,
+                            mode=op.perms)
+                        self.facts.forget_path(op.remote_path)
+                    if cache is not None:
+                        self.transport.after_flush(functools.partial(
+                            cache.record, op.remote_path, push_cache.DIRECTORY,
+                            op.owner, op.group, op.perms))
+            elif op.action == package_plan.RENDER:
+                if self.push_template(plan.template_name(op), op.remote_path,
+                                      template_env, op.owner, op.group,
+                                      op.perms):
+                    changed = True
+            elif op.action == package_plan.UPLOAD:
+                if self.push_file(op.local_path, op.remote_path,
+                                  op.owner, op.group, op.perms,
+                                  digest=op.digest):
+                    changed = True
+            elif op.action == package_plan.DELETE:
+                if self._needs_delete(cache, op.remote_path):
+                    deletes.append(op.remote_path)
+        if deletes:
+            output = self.transport.run(
+                package_plan.delete_command(deletes))
+            if '@@deleted' in output:
+                changed = True
+            self._record_deletes(cache, deletes)
+        return changed
+
+    def _needs_delete(self, cache, path):
+        '''
+        Check if a file named in a fck_delete.txt file has to be deleted,
+        or if the push cache shows it's already been deleted.  Glob
+        patterns always have to be checked, since new files can match
+        them at any time.
+
+        :type cache: push_cache.PushCache
+        :param cache: push cache for the computer, or None
+        :type path: string
+        :param path: remote path or glob pattern
+
+        :rtype: boolean
+        :return: True if the delete has to be done on the computer
+        '''
+        return (cache is None or package_plan.is_pattern(path) or
+                not cache.is_current(path, push_cache.DELETED,
+                                     None, None, None))
+
+    def _record_deletes(self, cache, paths):
+        '''
+        Record deleted files in the push cache, leaving out glob patterns.
+
+        :type cache: push_cache.PushCache
+        :param cache: push cache for the computer, or None
+        :type paths: list of strings
+        :param paths: remote paths and glob patterns that were deleted
+        '''
+        if cache is not None:
+            for path in paths:
+                if not package_plan.is_pattern(path):
+                    cache.record(path, push_cache.DELETED)
+
+    def _bulk_push_package_file_set(self, package_name, template_env):
+        '''
+        Implement the file copying and deleting portion of the
+        push_package_file_set operation in bulk.  The whole package,
+        templates included, is rendered into a single archive in a local
+        staging directory and uploaded in one transfer.  Then one remote
+        command unpacks it, creates directories, sets owners, groups, and
+        permissions, and deletes files named in fck_delete.txt files.
+
+        The archive holds the files to install (files.tar) and a shell
+        script that does everything else (fck_apply.sh), so the size of
+        the package doesn't affect the length of the remote command.  Files
+        whose contents are already on the remote server are left out of
+        the archive; their hashes are checked with one remote command
+        before the archive is built.
+
+        :type package_name: string
+        :param package_name: name of package to process, corresponds to directory in packages directory
+        :type template_env: dict
+        :param template_env: environment dictionary for template engine
+
+        :rtype: boolean
+        :return: True if any file was changed or deleted
         '''
-        metadata = FileMetaDataTracker()
-        deleter = FileDeleter()
-        work_dir = os.path.join(self.settings["package_dir"], package_name)
-        os.chdir(work_dir)
-        for root, dirs, files in os.walk('.'):
-            metadata.check_directory(root, dirs, files)
-            owner, group, perms = metadata.get_metadata(root)
-            remote_root = '/'+root.lstrip('.')
-            cuisine.dir_ensure(
-                remote_root, owner=owner, group=group, mode=perms)
-            for filename in files:
-                fq_filename = os.path.join(remote_root, filename).lstrip('/')
-                if (re.search(self.settings["file_ignores"], filename) is None
-                        and filename != metadata.tagfile
-                        and filename != deleter.tagfile):
-                    owner, group, perms = metadata.get_metadata(root, filename)
-                    base_path, ext = os.path.splitext(fq_filename)
-                    if ext == '.tmplt':
-                        self.push_template(os.path.join(package_name,
-                                                        fq_filename),
-                                           os.path.join('/', base_path),
-                                           template_env, owner, group, perms)
-                    else:
-                        self.push_file(os.path.join(work_dir, fq_filename),
-                                       os.path.join('/', fq_filename),
-                                       owner, group, perms)
-            deleter.check_directory(root, files, remote_root)
-
-    def push_package_file_set(self, package_name, computer_name, aux_env=None):
+        plan = package_plan.get_package_plan(self.settings, package_name)
+        cache = push_cache.get_push_cache(self.settings)
+        remote_dirs = []
+        remote_files = []
+        remote_deletes = []
+        contents = {}
+        for op in plan:
+            if op.action == package_plan.DIRECTORY:
+                if cache is None or not cache.is_current(
+                        op.remote_path, push_cache.DIRECTORY,
+                        op.owner, op.group, op.perms):
+                    remote_dirs.append((op.remote_path, op.owner, op.group,
+                                        op.perms))
+            elif op.action in (package_plan.RENDER, package_plan.UPLOAD):
+                if op.action == package_plan.RENDER:
+                    buff = self.render_template(plan.template_name(op),
+                                                template_env)
+                    if isinstance(buff, unicode):
+                        buff = buff.encode('utf-8')
+                    digest = push_cache.content_digest(buff)
+                else:
+                    buff = None
+                    digest = op.digest
+                if cache is not None and cache.is_current(
+                        op.remote_path, digest, op.owner, op.group, op.perms):
+                    continue
+                remote_files.append((op.remote_path, op.owner, op.group,
+                                     op.perms, digest))
+                contents[op.remote_path] = (op.local_path, buff)
+            elif op.action == package_plan.DELETE:
+                if self._needs_delete(cache, op.remote_path):
+                    remote_deletes.append(op.remote_path)
+
+        if not (remote_dirs or remote_files or remote_deletes):
+            return False
+
+        remote = push_cache.remote_digests([f[0] for f in remote_files],
+                                           self.transport.run)
+        upload = [f[0] for f in remote_files if remote[f[0]] != f[4]]
+
+        stage_dir = tempfile.mkdtemp(dir=self.settings["tmp_dir"])
+        try:
+            files_tar = tarfile.open(os.path.join(stage_dir, 'files.tar'), 'w')
+            for remote_name in upload:
+                local_name, buff = contents[remote_name]
+                if buff is not None:
+                    info = tarfile.TarInfo(remote_name.lstrip('/'))
+                    info.size = len(buff)
+                    info.mtime = time.time()
+                    info.mode = 0644
+                    files_tar.addfile(info, StringIO.StringIO(buff))
+                else:
+                    files_tar.add(local_name, remote_name.lstrip('/'),
+                                  recursive=False)
+            files_tar.close()
+
+            script = open(os.path.join(stage_dir, 'fck_apply.sh'), 'w')
+            script.write(self._bulk_apply_script(
+                remote_dirs, remote_files, remote_deletes))
+            script.close()
+
+            local_archive = os.path.join(stage_dir, 'package.tar.gz')
+            archive = tarfile.open(local_archive, 'w:gz')
+            archive.add(os.path.join(stage_dir, 'files.tar'), 'files.tar')
+            archive.add(os.path.join(stage_dir, 'fck_apply.sh'),
+                        'fck_apply.sh')
+            archive.close()
+
+            remote_archive = '/tmp/fck_%s_%s.tar.gz' % (package_name,
+                                                        uuid.uuid4().hex)
+            put(local_archive, remote_archive)
+            output = self.transport.run(
+                'd=$(mktemp -d) && '
+                'tar -xzf %(archive)s -C "$d" && '
+                'tar -xf "$d/files.tar" -C / --no-same-owner && '
+                'sh "$d/fck_apply.sh"; '
+                'rc=$?; rm -rf "$d" %(archive)s; exit $rc' %
+                {"archive": pipes.quote(remote_archive)})
+        finally:
+            shutil.rmtree(stage_dir)
+
+        if cache is not None:
+            for path, owner, group, perms in remote_dirs:
+                cache.record(path, push_cache.DIRECTORY, owner, group, perms)
+            for path, owner, group, perms, digest in remote_files:
+                cache.record(path, digest, owner, group, perms)
+        self._record_deletes(cache, remote_deletes)
+        return bool(upload) or '@@deleted' in output
+
+    def _bulk_apply_script(self, remote_dirs, remote_files, remote_deletes):
+        '''
+        Build the shell script that finishes a bulk package push on the
+        remote server, after the files have been unpacked into place.  It
+        prints a line starting with '@@deleted' for each file it deletes.
+
+        :type remote_dirs: list of tuples
+        :param remote_dirs: (path, owner, group, perms) for each directory
+        :type remote_files: list of tuples
+        :param remote_files: (path, owner, group, perms, digest) for each file
+        :type remote_deletes: list of strings
+        :param remote_deletes: paths and glob patterns of files to delete
+
+        :rtype: string
+        :return: contents of the shell script
+        '''
+        def add_commands(command, paths):
+            # keep each command line to a reasonable length
+            for i in range(0, len(paths), 100):
+                lines.append(command % ' '.join(
+                    [pipes.quote(p) for p in paths[i:i + 100]]))
+
+        def group_paths(entries, index):
+            groups = {}
+            order = []
+            for entry in entries:
+                if entry[index]:
+                    if entry[index] not in groups:
+                        groups[entry[index]] = []
+                        order.append(entry[index])
+                    groups[entry[index]].append(entry[0])
+            return [(key, groups[key]) for key in order]
+
+        lines = ['set -e']
+        add_commands('mkdir -p %s',
+                     [d[0] for d in remote_dirs if d[0] != '/'])
+        for entries in (remote_dirs, remote_files):
+            for perms, paths in group_paths(entries, 3):
+                add_commands('chmod %s %%s' % perms, paths)
+            for owner, paths in group_paths(entries, 1):
+                add_commands('chown %s %%s' % owner, paths)
+            for group, paths in group_paths(entries, 2):
+                add_commands('chgrp %s %%s' % group, paths)
+        if remote_deletes:
+            lines.append(package_plan.delete_command(remote_deletes))
+        return '\n'.join(lines) + '\n'
+
+    def push_package_file_set(self, package_name, computer_name, aux_env=None,
+                              bulk=None, notify=None):
         '''
         Copy a set of files to a remote server, maintaining the same directory
         structure and processing any templates encountered. This copies the
@@ -433,7 +750,11 @@ class Recipe(object):
         For template file processing, a default environment dictionary will be
         passed in consisting of::
 
-          {"computer": host_env["computers"][computer_name]}
+          {"computer": host_env["computers"][computer_name],
+           "environment": host_env}
+
+        The environment is an Environment, so templates can use its
+        indexes, for example environment.members(group).
 
         Template files have a .tmplt extension.
 
@@ -452,20 +773,64 @@ class Recipe(object):
         one per line.  This way you can clean out a directory as well as copy
         files to it.
 
+        If notify is given, those handlers are notified when any file in the
+        package is changed or deleted.  See notify().
+
+        Normally every directory and file is handled with its own remote
+        commands, though with the "batch_commands" setting directories and
+        permissions are set together, along with the commands that check
+        the files.  In bulk mode the whole package is instead uploaded as one
+        archive and put into place with a single remote command, which is
+        much faster for packages with lots of files.  Bulk mode is used if
+        bulk is True, or if bulk is None and the "bulk_push" setting is
+        true.
+
         :type package_name: string
         :param package_name: name of package to process, corresponds to directory in packages directory
         :type template_env: dict
         :param template_env: environment dictionary for template engine
         :type aux_env: dict
         :param aux_env: additional key/value pairs for the template environment
+        :type bulk: boolean
+        :param bulk: push the package in bulk mode (None to use the "bulk_push" setting)
+        :type notify: string or list of strings
+        :param notify: handlers to notify if any file was changed or deleted
+
+        :rtype: boolean
+        :return: True if any file was changed or deleted
+        '''
+        with timing.timed('push_package', package_name), \
+                self.transport.batch():
+            template_env = prerender.package_template_env(
+                self.environment, computer_name, aux_env)
+            if bulk is None:
+                bulk = self.settings.get("bulk_push", False)
+            if bulk:
+                changed = self._bulk_push_package_file_set(package_name,
+                                                           template_env)
+            else:
+                changed = self._push_package_file_set(package_name,
+                                                      template_env)
+            if changed and notify:
+                self.notify(notify)
+            return changed
+
+    def edit_file(self, filepath):
         '''
-        template_env = {"computer":
-                        self.environment["computers"][computer_name]}
-        if aux_env is not None:
-            template_env.update(aux_env)
-        self._push_package_file_set(package_name, template_env)
+        Start a set of line edits to a file on the remote filesystem.
+        Queue up edits on the LineEditor this returns, then call its
+        apply() function to do them all with one remote command.
+
+        :type filepath: string
+        :param filepath: fully-qualified path to remote file
 
-    def append_line_to_file(self, tag, add_line, filepath):
+        :rtype: LineEditor
+        :return: editor for the file
+        '''
+        return LineEditor(filepath)
+
+    def append_line_to_file(self, tag, add_line, filepath, regex=False,
+                            notify=None):
         '''
         Append a line to a file on the remote filesystem if it's not
         there already.  Look for the tag to see if the line is there
@@ -478,50 +843,54 @@ class Recipe(object):
         :param add_line: line to append to file
         :type filepath: string
         :param filepath: fully-qualified path to remote file
+        :type regex: boolean
+        :param regex: tag is a regular expression
+        :type notify: string or list of strings
+        :param notify: handlers to notify if the line was appended
+
+        :rtype: boolean
+        :return: True if the line was appended
         '''
-        old_contents = cuisine.file_read(filepath)
-        eol = cuisine.text_detect_eol(old_contents)
-        old_contents = old_contents.rstrip(eol)
-        old_contents = old_contents.split(eol)
-        has_line = False
-        for line in old_contents:
-            print line
-            if line.find(tag) != -1:
-                has_line = True
-                continue
-        if not has_line:
-            old_contents.append(add_line)
-            cuisine.file_write(filepath, eol.join(old_contents) + eol)
+        return self.edit_file(filepath).append_line(
+            tag, add_line, regex).apply(notify)
 
-    def find_replace_in_file(self, old_text, new_text, filepath):
+    def find_replace_in_file(self, old_text, new_text, filepath,
+                             regex=False, notify=None):
         '''
-        Find and replace text in a file on the remote filesystem.
+        Find and replace text in a file on the remote filesystem.  The
+        file is only written if something was replaced.
 
         :type old_text: string
-        :param tag: text to replace
+        :param old_text: text to replace
         :type new_text: string
-        :param add_line: text to replace with
+        :param new_text: text to replace with
         :type filepath: string
         :param filepath: fully-qualified path to remote file
+        :type regex: boolean
+        :param regex: old_text is a regular expression
+        :type notify: string or list of strings
+        :param notify: handlers to notify if the file changed
+
+        :rtype: boolean
+        :return: True if the file changed
         '''
-        old_contents = cuisine.file_read(filepath)
-        eol = cuisine.text_detect_eol(old_contents)
-        old_contents = old_contents.split(eol)
-        new_contents = []
-        for line in old_contents:
-            print line
-            new_line = line.replace(old_text, new_text)
-            new_contents.append(new_line)
-        cuisine.file_write(filepath, eol.join(new_contents))
+        return self.edit_file(filepath).replace(
+            old_text, new_text, regex).apply(notify)
 
     ##############################
     ######## GIT HANDLING ########
     ##############################
 
-    def push_git_repo(self, computer, user, group, git_url, target_path):
+    def push_git_repo(self, computer, user, group, git_url, target_path,
+                      ref='HEAD'):
         '''
-        Make a local clone of the repo in git_url into the temp directory
-        specified in the settings file, then rsync it to the remote path.
+        Check out a git repo from frycook's local git cache, then rsync it
+        to the remote path.  The repo's mirror in the cache is only
+        fetched once per run and each commit is only checked out once, so
+        pushing the same repo to lots of computers costs one fetch plus
+        one rsync per computer.  The rsync goes over the computer's ssh
+        control master when there is one, connecting as fabric's user and
+        running rsync on the computer through sudo unless that's root.
 
         :type computer: string
         :param computer: computer name to push to
@@ -533,21 +902,28 @@ class Recipe(object):
         :param git_url: git url of repo (probably from github)
         :type target_path: string
         :param target_path: root path on remote server to copy git repo to
+        :type ref: string
+        :param ref: branch, tag, or commit to push
+
+        :rtype: string
+        :return: SHA of the commit that was pushed
         '''
         rsync_command = ('rsync -qrlptz --delete --delete-excluded '
                          '--exclude=.svn --exclude=.git')
-        tmp_path = os.path.join(self.settings["tmp_dir"],
-                                'push_git_repo/repo/')
-        if not os.path.exists(tmp_path):
-            local('git clone %s %s' % (git_url, tmp_path))
-        else:
-            local('cd %s && git pull' % tmp_path)
-        local('%s %s root@%s:%s' %
-              (rsync_command, tmp_path, computer, target_path))
+        tree, sha = get_checkout(self.settings, git_url, ref)
+        # connect as the user fabric uses, so the control master's socket
+        # is found, and write the files as root through sudo
+        destination, port = get_ssh_destination(computer)
+        if not destination.startswith('root@'):
+            rsync_command += ' --rsync-path=%s' % pipes.quote('sudo rsync')
+        local('%s -e %s %s %s:%s' %
+              (rsync_command,
+               pipes.quote('%s -p %s' % (get_ssh_command(), port)),
+               pipes.quote(tree + '/'), destination, target_path))
         cuisine.sudo('chown -R %s:%s %s' % (user, group, target_path))
-        shutil.rmtree(tmp_path)
+        return sha
 
-    def clone_git_repo(self, user, git_url, target_path):
+    def clone_git_repo(self, user, git_url, target_path, depth=None):
         '''
         Clone a git repo on a remote server.
 
@@ -555,9 +931,14 @@ class Recipe(object):
         :param git_url: git url of repo (probably from github)
         :type target_path: string
         :param target_path: root path on remote server to clone git repo into
+        :type depth: int
+        :param depth: only clone this many commits of history (None for all)
         '''
-        cuisine.sudo('sudo -Hi -u %s git clone %s %s' %
-                     (user, git_url, target_path))
+        depth_option = '--depth %d ' % depth if depth else ''
+        cuisine.sudo('sudo -Hi -u %s git clone %s%s %s' %
+                     (user, depth_option, git_url, target_path))
+        self.facts.forget_path(target_path)
+        self.facts.forget_path(os.path.join(target_path, '.git'))
 
     def update_git_repo(self, user, git_url, target_path):
         '''
@@ -570,13 +951,62 @@ class Recipe(object):
         '''
         cuisine.sudo('cd %s && sudo -u %s git pull' % (target_path, user))
 
-    def is_git_repo(self, target_path):
+    def deploy_git_repo(self, user, git_url, target_path, ref='master',
+                        depth=1, notify=None):
         '''
-        Make sure the target path exists on the remote computer and is
-        really a git repo.
+        Make sure a git repo on a remote server is checked out at a
+        branch, tag, or commit, cloning it if it isn't there yet.  This
+        is all done with one remote command.  If the repo is already at
+        the commit the ref points to nothing else happens, so applying
+        this again is nearly free.  Otherwise only that commit is
+        fetched, with a shallow fetch if the repo is new or was deployed
+        shallow to begin with.  The repo is left with the commit checked
+        out on a detached HEAD.
 
+        :type user: string
+        :param user: user to own the repo and run git as
         :type git_url: string
         :param git_url: git url of repo (probably from github)
+        :type target_path: string
+        :param target_path: root path on remote server for the repo
+        :type ref: string
+        :param ref: branch, tag, or full commit SHA to deploy
+        :type depth: int
+        :param depth: how many commits of history to fetch for a new repo (None for all)
+        :type notify: string or list of strings
+        :param notify: handlers to notify if the checked out commit changed
+
+        :rtype: tuple of (string, string)
+        :return: (SHA checked out before, or None for a new repo, SHA checked out now)
+        '''
+        script = _GIT_DEPLOY_SCRIPT % {
+            "url": pipes.quote(git_url),
+            "dir": pipes.quote(target_path),
+            "ref": pipes.quote(ref),
+            "is_sha": 'true' if _SHA_RE.match(ref) else 'false',
+            "depth": '--depth %d' % depth if depth else ''}
+        output = cuisine.sudo('sudo -H -u %s sh -c %s' %
+                              (user, pipes.quote(script)))
+        before, after = None, None
+        for line in output.splitlines():
+            if line.startswith('@@deploy '):
+                parts = line.split()
+                before, after = (parts[1] if len(parts) > 2 else None,
+                                 parts[-1])
+        print "git repo %s at %s: %s -> %s" % (
+            target_path, ref, before or '(new)', after)
+        if before != after:
+            self.facts.forget_path(target_path)
+            self.facts.forget_path(os.path.join(target_path, '.git'))
+            if notify:
+                self.notify(notify)
+        return before, after
+
+    def is_git_repo(self, target_path):
+        '''
+        Make sure the target path exists on the remote computer and is
+        really a git repo, with one remote command.
+
         :type target_path: string
         :param target_path: root path on remote server to check git repo
 
@@ -584,12 +1014,10 @@ class Recipe(object):
         :return: True if repo already existed, False if not
 
         '''
-        if not cuisine.dir_exists(os.path.join(target_path, '.git')):
-            return False
-        ret = cuisine.sudo('cd %s && git status' % target_path)
-        if not ret.succeeded:
-            return False
-        return True
+        ret = cuisine.sudo('cd %s 2>/dev/null && '
+                           'git rev-parse --git-dir >/dev/null 2>&1 && '
+                           'echo @@git || true' % pipes.quote(target_path))
+        return ret.strip().endswith('@@git')
 
     def ensure_git_repo(self, user, git_url, target_path):
         '''
@@ -604,7 +1032,7 @@ class Recipe(object):
         :rtype: boolean
         :return: True if repo already existed, False if not
         '''
-        if not cuisine.dir_exists(target_path):
+        if not self.facts.is_dir(target_path):
             self.clone_git_repo(user, git_url, target_path)
             return False
         return True
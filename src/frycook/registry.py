@@ -0,0 +1,143 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+The recipe and cookbook lists in the recipes and cookbooks packages map
+names to classes.  Importing every recipe and cookbook module just to
+find out what names there are is slow for big globules, so the lists
+can name the classes with strings of the form 'module.ClassName'
+instead, relative to the package.  A registry wraps one of these lists
+and only imports a module the first time one of its classes is needed.
+Lists that map names straight to classes still work.
+'''
+import importlib
+import threading
+
+
+class RegistryException(Exception):
+    '''
+    A RegistryException exception is raised when a name isn't in a
+    registry or its class can't be found.
+    '''
+    pass
+
+
+class Registry(object):
+    '''
+    A Registry looks up recipe or cookbook classes by name, importing
+    them only when they're asked for.
+    '''
+
+    def __init__(self, package, classes):
+        '''
+        Wrap a recipe or cookbook list.
+
+        :type package: string
+        :param package: name of the package the list is from, ie. 'recipes'
+        :type classes: dict
+        :param classes: name -> class, or name -> 'module.ClassName' string
+        '''
+        self.package = package
+        self.classes = dict(classes)
+        self.lock = threading.Lock()
+
+    def names(self):
+        '''
+        Get the names in the registry, without importing anything.
+
+        :rtype: list of strings
+        :return: sorted names
+        '''
+        return sorted(self.classes)
+
+    def __contains__(self, name):
+        return name in self.classes
+
+    def _path(self, name):
+        '''
+        Get the full dotted path of the class for a name.
+
+        :type name: string
+        :param name: recipe or cookbook name
+
+        :rtype: string
+        :return: 'package.module.ClassName'
+        '''
+        cls = self.classes[name]
+        if isinstance(cls, basestring):
+            return '%s.%s' % (self.package, cls)
+        return '%s.%s' % (cls.__module__, cls.__name__)
+
+    def get(self, name):
+        '''
+        Get the class for a name, importing its module if it hasn't been
+        imported yet.
+
+        :type name: string
+        :param name: recipe or cookbook name
+
+        :rtype: class
+        :return: recipe or cookbook class
+
+        :raises RegistryException: raised if the name isn't in the registry or its class can't be imported
+        '''
+        with self.lock:
+            if name not in self.classes:
+                raise RegistryException(
+                    "%s has no entry named %s" % (self.package, name))
+            cls = self.classes[name]
+            if isinstance(cls, basestring):
+                module_name, _, class_name = self._path(name).rpartition('.')
+                try:
+                    cls = getattr(importlib.import_module(module_name),
+                                  class_name)
+                except (ImportError, AttributeError), e:
+                    raise RegistryException(
+                        "can't load %s for %s: %s" % (self._path(name),
+                                                      name, e))
+                self.classes[name] = cls
+            return cls
+
+    __getitem__ = get
+
+    def name_of(self, cls):
+        '''
+        Get the name a class is registered under, without importing
+        anything that hasn't been imported yet.
+
+        :type cls: class
+        :param cls: recipe or cookbook class
+
+        :rtype: string
+        :return: registered name, or None if the class isn't registered
+        '''
+        path = '%s.%s' % (cls.__module__, cls.__name__)
+        with self.lock:
+            for name in self.classes:
+                if self._path(name) == path:
+                    return name
+        return None
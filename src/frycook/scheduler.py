@@ -0,0 +1,252 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+The scheduler decides the order that the recipes in a computer's run
+list are applied in.  Recipes are applied one at a time: fabric's env and
+output settings are global to the process, and cuisine switches them
+around every remote command, so recipes on separate threads would trip
+over each other.
+'''
+import timing
+from cookbook_template import Cookbook
+from packages import install_packages
+from recipe_template import Recipe
+from transport import flush_transport
+
+
+class SchedulerException(Exception):
+    '''
+    A SchedulerException exception is raised when the recipes in a run
+    list can't be put in any order that satisfies their requirements.
+    '''
+    pass
+
+
+def _overrides(cls, base, name):
+    '''
+    Check if a class overrides a method of a base class.
+
+    :type cls: class
+    :param cls: class to check
+    :type base: class
+    :param base: base class
+    :type name: string
+    :param name: name of the method
+
+    :rtype: boolean
+    :return: True if the class has its own version of the method
+    '''
+    return getattr(cls, name).__func__ is not getattr(base, name).__func__
+
+
+def is_plain_cookbook(cls):
+    '''
+    Check if a cookbook class does nothing but apply its recipes, which
+    means it can be flattened into them.  Cookbooks that override
+    pre_apply_checks(), apply(), run_apply(), or health_check() do more
+    than that.
+
+    :type cls: class
+    :param cls: Cookbook subclass
+
+    :rtype: boolean
+    :return: True if the cookbook can be flattened
+    '''
+    return not (_overrides(cls, Cookbook, 'pre_apply_checks') or
+                _overrides(cls, Cookbook, 'apply') or
+                _overrides(cls, Cookbook, 'run_apply') or
+                _overrides(cls, Cookbook, 'health_check'))
+
+
+def expand_components(components):
+    '''
+    Flatten a run list of recipes and cookbooks into the recipes that
+    make it up, dropping any recipe that has already appeared earlier in
+    the run list.  Cookbooks that aren't plain cookbooks are kept whole
+    instead of being flattened.
+
+    :type components: list of Recipe and Cookbook objects
+    :param components: run list for a computer
+
+    :rtype: list of Recipe and Cookbook objects
+    :return: flattened run list
+    '''
+    seen = set()
+    nodes = []
+    for component in components:
+        if (isinstance(component, Cookbook) and
+                is_plain_cookbook(type(component))):
+            parts = component.recipes
+        else:
+            parts = [component]
+        for part in parts:
+            if type(part) not in seen:
+                seen.add(type(part))
+                nodes.append(part)
+    return nodes
+
+
+def get_provides(node):
+    '''
+    Get everything a recipe or cookbook provides.  That's the names in its
+    provides class variable plus its class name.  A cookbook that wasn't
+    flattened also provides everything its recipes provide.
+
+    :type node: Recipe or Cookbook object
+    :param node: recipe or cookbook
+
+    :rtype: list of strings
+    :return: names of the things it provides
+    '''
+    provides = [type(node).__name__] + list(getattr(node, 'provides', []))
+    if isinstance(node, Cookbook):
+        for recipe in node.recipes:
+            provides.extend(get_provides(recipe))
+    return provides
+
+
+class RecipeScheduler(object):
+    '''
+    A RecipeScheduler object applies a computer's run list according to
+    the requirements of its recipes.
+
+    Recipes say what they need with the requires class variable, a list
+    of names of things provided by other recipes.  Every recipe provides
+    its own class name and anything in its provides class variable.  A
+    recipe only has to come after the recipes that provide what it
+    requires.
+
+    A recipe that leaves requires as None, which is the default, waits
+    for everything before it in the run list, so run lists made of those
+    recipes are applied strictly in order, just like always.
+    '''
+
+    def __init__(self, components):
+        '''
+        Flatten the run list and work out what each recipe waits for.
+
+        :type components: list of Recipe and Cookbook objects
+        :param components: run list for a computer
+        :raises SchedulerException: raised if the requirements form a cycle
+        '''
+        self.nodes = expand_components(components)
+        providers = {}
+        for i, node in enumerate(self.nodes):
+            for name in get_provides(node):
+                providers.setdefault(name, set()).add(i)
+
+        # requirements that nothing in the run list provides are assumed
+        # to have been applied some other time
+        self.deps = []
+        for i, node in enumerate(self.nodes):
+            requires = getattr(node, 'requires', None)
+            if requires is None:
+                deps = set(range(i))
+            else:
+                deps = set()
+                for name in requires:
+                    deps.update(providers.get(name, set()))
+                deps.discard(i)
+            self.deps.append(deps)
+        self.order = self._sort()
+
+    def _sort(self):
+        '''
+        Sort the recipes so that each one comes after everything it waits
+        for, keeping the run list order as much as possible.
+
+        :rtype: list of ints
+        :return: indexes of the recipes in the order to apply them
+        :raises SchedulerException: raised if the requirements form a cycle
+        '''
+        order = []
+        done = set()
+        while len(order) < len(self.nodes):
+            ready = [i for i in range(len(self.nodes))
+                     if i not in done and self.deps[i] <= done]
+            if not ready:
+                raise SchedulerException(
+                    "recipe requirements form a cycle: %s" % ', '.join(
+                        [type(self.nodes[i]).__name__
+                         for i in range(len(self.nodes)) if i not in done]))
+            order.append(ready[0])
+            done.add(ready[0])
+        return order
+
+    def _apply_node(self, node, computer):
+        '''
+        Apply a single recipe or cookbook.  Its checks were already run by
+        run(), unless it overrides run_apply(), in which case that's
+        called instead.  Any remote operations it left queued are run
+        once it's done.
+
+        :type node: Recipe or Cookbook object
+        :param node: recipe or cookbook to apply
+        :type computer: string
+        :param computer: name of computer to apply to
+        '''
+        base = Recipe if isinstance(node, Recipe) else Cookbook
+        with timing.recipe(type(node).__name__), timing.timed('recipe'):
+            if _overrides(type(node), base, 'run_apply'):
+                with timing.timed('run_apply'):
+                    node.run_apply(computer)
+            else:
+                with timing.timed('packages'):
+                    install_packages(node.packages)
+                with timing.timed('apply'):
+                    node.apply(computer)
+            flush_transport()
+
+    def run(self, computer):
+        '''
+        Run the checks for every recipe, then apply them one at a time.
+
+        :type computer: string
+        :param computer: name of computer to apply to
+        '''
+        for node in self.nodes:
+            with timing.recipe(type(node).__name__), \
+                    timing.timed('pre_apply_checks'):
+                node.pre_apply_checks(computer)
+
+        for i in self.order:
+            self._apply_node(self.nodes[i], computer)
+
+    def health_check(self, computer):
+        '''
+        Run the health checks for every recipe, in the order they were
+        applied.
+
+        :type computer: string
+        :param computer: name of computer to check
+        '''
+        for i in self.order:
+            node = self.nodes[i]
+            with timing.recipe(type(node).__name__), \
+                    timing.timed('health_check'):
+                node.health_check(computer)
@@ -0,0 +1,69 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+All recipes share one Mako template lookup per packages directory, so
+each template is only parsed and compiled once no matter how many
+recipes and computers use it.  The compiled templates are also kept in
+frycook's local cache directory, so later runs don't have to compile
+them again unless the template files change.
+'''
+import hashlib
+import os.path
+import threading
+
+from mako.lookup import TemplateLookup
+
+from local_cache import get_cache_dir
+
+# template lookups by packages directory
+_lookups = {}
+_lookups_lock = threading.Lock()
+
+
+def get_template_lookup(settings):
+    '''
+    Get the shared template lookup for the packages directory in the
+    settings, creating it the first time it's asked for.  Compiled
+    templates are written to a directory under the cache directory that
+    is specific to the packages directory, and Mako recompiles a
+    template whenever its file is newer than its compiled module.
+
+    :type settings: dict
+    :param settings: settings dictionary
+
+    :rtype: mako.lookup.TemplateLookup
+    :return: template lookup for the packages directory
+    '''
+    package_dir = os.path.abspath(settings["package_dir"])
+    with _lookups_lock:
+        if package_dir not in _lookups:
+            module_dir = get_cache_dir(
+                settings, 'mako', hashlib.sha1(package_dir).hexdigest())
+            _lookups[package_dir] = TemplateLookup(
+                directories=[package_dir], module_directory=module_dir)
+        return _lookups[package_dir]
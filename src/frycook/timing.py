@@ -0,0 +1,222 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Timing records how long each part of a run takes: connecting, gathering
+facts, installing packages, each recipe's checks and apply, each file
+pushed, and with instrument_remote_commands() each remote command.
+Records are kept per process; the worker processes of a parallel apply
+send theirs back to frycooker.py along with their results.  At the end
+of a run frycooker.py can write them all out as a JSON report and print
+the slowest of them.
+'''
+import contextlib
+import json
+import threading
+import time
+
+import cuisine
+from fabric.api import env
+
+# timing records for this process
+_records = []
+_records_lock = threading.Lock()
+
+# the recipe being worked on by each thread
+_current = threading.local()
+
+
+def record(phase, name, start, seconds, host=None):
+    '''
+    Record how long something took, for the recipe the current thread is
+    working on and the host fabric is currently pointed at, unless a host
+    is given.
+
+    :type phase: string
+    :param phase: kind of thing that was timed, ie. 'apply' or 'push_file'
+    :type name: string
+    :param name: what was timed, ie. a remote path, or None
+    :type start: float
+    :param start: time it started, in seconds since the epoch
+    :type seconds: float
+    :param seconds: how long it took
+    :type host: string
+    :param host: host it was for, or None for the current host
+    '''
+    if host is None:
+        host = env.host_string
+    entry = {"host": host,
+             "recipe": getattr(_current, 'recipe', None),
+             "phase": phase,
+             "name": name,
+             "start": start,
+             "seconds": seconds}
+    with _records_lock:
+        _records.append(entry)
+
+
+@contextlib.contextmanager
+def timed(phase, name=None):
+    '''
+    Context manager that records how long its body takes.
+
+    :type phase: string
+    :param phase: kind of thing being timed, ie. 'apply' or 'push_file'
+    :type name: string
+    :param name: what's being timed, ie. a remote path
+    '''
+    start = time.time()
+    try:
+        yield
+    finally:
+        record(phase, name, start, time.time() - start)
+
+
+@contextlib.contextmanager
+def recipe(name):
+    '''
+    Context manager that attributes everything timed in its body, on the
+    current thread, to a recipe.
+
+    :type name: string
+    :param name: name of the recipe or cookbook
+    '''
+    previous = getattr(_current, 'recipe', None)
+    _current.recipe = name
+    try:
+        yield
+    finally:
+        _current.recipe = previous
+
+
+def _timed_command(phase, func):
+    '''
+    Wrap a cuisine command function so its calls are timed.
+    '''
+    def wrapper(command, *args, **kwargs):
+        with timed(phase, command.split('\n', 1)[0][:100]):
+            return func(command, *args, **kwargs)
+    wrapper.fck_timed = True
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
+def instrument_remote_commands():
+    '''
+    Time every remote command run through cuisine.run() and
+    cuisine.sudo(), which includes the ones run by cuisine's own
+    functions.
+    '''
+    for name in ('run', 'sudo'):
+        func = getattr(cuisine, name)
+        if not getattr(func, 'fck_timed', False):
+            setattr(cuisine, name, _timed_command(name, func))
+
+
+def get_records():
+    '''
+    Get the timing records for this process.
+
+    :rtype: list of dicts
+    :return: records, in the order they were finished
+    '''
+    with _records_lock:
+        return list(_records)
+
+
+def add_records(records):
+    '''
+    Add records from another process, such as a parallel apply worker.
+
+    :type records: list of dicts
+    :param records: records to add
+    '''
+    with _records_lock:
+        _records.extend(records)
+
+
+def clear_records():
+    '''
+    Throw away the timing records for this process.
+    '''
+    with _records_lock:
+        del _records[:]
+
+
+def write_report(filename, records, run_id=None):
+    '''
+    Write timing records out as a JSON report, along with the total time
+    for each host and for each recipe on each host.
+
+    :type filename: string
+    :param filename: file to write the report to
+    :type records: list of dicts
+    :param records: timing records
+    :type run_id: string
+    :param run_id: id of the run the records are from
+    '''
+    hosts = {}
+    recipes = {}
+    for entry in records:
+        if entry["phase"] == "host":
+            hosts[entry["host"]] = entry["seconds"]
+        elif entry["phase"] == "recipe":
+            recipes.setdefault(entry["host"], {})[entry["recipe"]] = \
+                entry["seconds"]
+    report = {"run_id": run_id,
+              "hosts": hosts,
+              "recipes": recipes,
+              "records": sorted(records, key=lambda r: r["start"])}
+    f = open(filename, 'w')
+    try:
+        json.dump(report, f, sort_keys=True, indent=4,
+                  separators=(',', ': '))
+    finally:
+        f.close()
+
+
+def output_slowest(records, count=10):
+    '''
+    Print the slowest things recorded, leaving out the per-host and
+    per-recipe totals.
+
+    :type records: list of dicts
+    :param records: timing records
+    :type count: int
+    :param count: how many to print
+    '''
+    entries = [entry for entry in records
+               if entry["phase"] not in ("host", "recipe")]
+    entries.sort(key=lambda r: r["seconds"], reverse=True)
+    print "slowest operations:"
+    for entry in entries[:count]:
+        print "    %8.2fs  %s  %s%s%s" % (
+            entry["seconds"], entry["host"],
+            entry["recipe"] + "  " if entry["recipe"] else "",
+            entry["phase"],
+            ": %s" % entry["name"] if entry["name"] else "")
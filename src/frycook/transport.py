@@ -0,0 +1,468 @@
+# Copyright (c) James Yates Farrimond. All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# Modification, are permitted provided that the following conditions are met:
+#
+# Redistributions of source code must retain the above copyright notice, this
+# list of conditions and the following disclaimer.
+#
+# Redistributions in binary form must reproduce the above copyright notice,
+# this list of conditions and the following disclaimer in the documentation
+# and/or other materials provided with the distribution.
+#
+# THIS SOFTWARE IS PROVIDED BY JAMES YATES FARRIMOND ''AS IS'' AND ANY EXPRESS
+# OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED WARRANTIES
+# OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO
+# EVENT SHALL JAMES YATES FARRIMOND OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT,
+# INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+#
+# The views and conclusions contained in the software and documentation are
+# those of the authors and should not be interpreted as representing official
+# policies, either expressed or implied, of James Yates Farrimond.
+
+'''
+Transports carry out remote operations for recipes.  The immediate
+transport runs each operation as soon as it's asked for, the same as
+calling cuisine directly.  The batching transport queues operations that
+are safe to put off, like creating directories and setting owners and
+permissions, and runs them all as one remote script at the next point
+where they have to be done: when a command whose output is needed runs
+(the queued operations run ahead of it in the same remote command), when
+a file is uploaded after a directory was queued, at the end of a batch,
+and after each recipe is applied.  The batching transport is used if the
+"batch_commands" setting is true.
+'''
+import contextlib
+import pipes
+import StringIO
+import threading
+
+import cuisine
+from fabric.api import env, put
+
+# most queued operations run in one remote command
+MAX_OPERATIONS = 500
+
+# transports for the hosts handled by this process, by host name
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+class _NoBatch(object):
+    '''
+    Context manager for a batch that doesn't queue anything.
+    '''
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, tb):
+        pass
+
+_no_batch = _NoBatch()
+
+
+class ImmediateTransport(object):
+    '''
+    Runs every operation on the host right away.
+    '''
+    def run(self, cmd):
+        '''
+        Run a command on the host and return its output.
+
+        :type cmd: string
+        :param cmd: shell command
+
+        :rtype: string
+        :return: output of the command
+        '''
+        return cuisine.run(cmd)
+
+    def sudo(self, cmd):
+        '''
+        Run a command on the host as root and return its output.
+
+        :type cmd: string
+        :param cmd: shell command
+
+        :rtype: string
+        :return: output of the command
+        '''
+        return cuisine.sudo(cmd)
+
+    def file_upload(self, remote_name, local_name):
+        '''
+        Upload a local file to the host.  Unlike cuisine's file_upload(),
+        this doesn't check whether the file is already there first; the
+        push functions have already compared digests by the time they
+        call it.
+
+        :type remote_name: string
+        :param remote_name: remote path to write the file to
+        :type local_name: string
+        :param local_name: local path of the file
+        '''
+        put(local_name, remote_name, use_sudo=cuisine.is_sudo())
+
+    def file_write(self, remote_name, content):
+        '''
+        Write a string to a file on the host.  Unlike cuisine's
+        file_write(), this doesn't compare hashes before or after; the
+        push functions have already compared digests by the time they
+        call it.
+
+        :type remote_name: string
+        :param remote_name: remote path to write the file to
+        :type content: string
+        :param content: contents of the file
+        '''
+        put(StringIO.StringIO(content), remote_name,
+            use_sudo=cuisine.is_sudo())
+
+    def dir_ensure(self, path, owner=None, group=None, mode=None):
+        '''
+        Make sure a directory exists on the host, with the given owner,
+        group, and permissions.
+
+        :type path: string
+        :param path: remote path of the directory
+        :type owner: string
+        :param owner: owner of the directory
+        :type group: string
+        :param group: group of the directory
+        :type mode: string
+        :param mode: permissions for the directory, ie. '755'
+        '''
+        cuisine.dir_ensure(path, owner=owner, group=group, mode=mode)
+
+    def file_attribs(self, path, owner=None, group=None, mode=None):
+        '''
+        Set the owner, group, and permissions of a file on the host.
+
+        :type path: string
+        :param path: remote path of the file
+        :type owner: string
+        :param owner: owner of the file
+        :type group: string
+        :param group: group of the file
+        :type mode: string
+        :param mode: permissions for the file, ie. '644'
+        '''
+        cuisine.file_attribs(path, mode=mode, owner=owner, group=group)
+
+    def file_link(self, source, destination):
+        '''
+        Make a symbolic link on the host.
+
+        :type source: string
+        :param source: path the link points to
+        :type destination: string
+        :param destination: path of the link
+        '''
+        cuisine.file_link(source, destination)
+
+    def file_unlink(self, path):
+        '''
+        Remove a file or symbolic link on the host, if it's there.
+
+        :type path: string
+        :param path: path of the file or link
+        '''
+        cuisine.file_unlink(path)
+
+    def user_ensure(self, name):
+        '''
+        Make sure a user exists on the host.
+
+        :type name: string
+        :param name: name of the user
+        '''
+        cuisine.user_ensure(name)
+
+    def group_ensure(self, name):
+        '''
+        Make sure a group exists on the host.
+
+        :type name: string
+        :param name: name of the group
+        '''
+        cuisine.group_ensure(name)
+
+    def group_user_ensure(self, group, user):
+        '''
+        Make sure a user is a member of a group on the host.
+
+        :type group: string
+        :param group: name of the group
+        :type user: string
+        :param user: name of the user
+        '''
+        cuisine.group_user_ensure(group, user)
+
+    def after_flush(self, callback):
+        '''
+        Call a function once the operations queued so far have been run
+        on the host.  Nothing is ever queued here, so it's called right
+        away.
+
+        :type callback: function
+        :param callback: function to call, with no arguments
+        '''
+        callback()
+
+    def flush(self):
+        '''
+        Run any queued operations.  Nothing is ever queued here.
+        '''
+        pass
+
+    def batch(self):
+        '''
+        Queue operations until the end of the block, then run them.
+        Nothing is queued here, so this does nothing.
+
+        :rtype: context manager
+        :return: context manager for the block
+        '''
+        return _no_batch
+
+
+class BatchingTransport(ImmediateTransport):
+    '''
+    Queues the operations that can be put off and runs them together as
+    one remote script.  Commands whose output is needed and file uploads
+    still happen right away.
+    '''
+    def __init__(self):
+        self.operations = []
+        self.callbacks = []
+        self.barrier = False
+        self.lock = threading.RLock()
+        self.local = threading.local()
+
+    def _queue(self, commands, barrier=False):
+        '''
+        Queue shell commands to run on the host.
+
+        :type commands: list of strings
+        :param commands: shell commands
+        :type barrier: boolean
+        :param barrier: whether uploads have to wait for these commands
+        '''
+        with self.lock:
+            self.operations.extend(commands)
+            self.barrier = self.barrier or barrier
+
+    def _take_script(self):
+        '''
+        Take the queued operations off the queue as a script, along with
+        the functions waiting for them.  If there are too many for one
+        command, all but the last of them are run now.
+
+        :rtype: tuple of (string, list of functions)
+        :return: (script, or None if nothing is queued, functions to call once it succeeds)
+        '''
+        operations = self.operations
+        callbacks = self.callbacks
+        self.operations = []
+        self.callbacks = []
+        self.barrier = False
+        while len(operations) > MAX_OPERATIONS:
+            result = cuisine.run(
+                'set -e\n' + '\n'.join(operations[:MAX_OPERATIONS]))
+            if getattr(result, 'failed', False):
+                callbacks = []
+            operations = operations[MAX_OPERATIONS:]
+        if not operations:
+            return None, callbacks
+        return '\n'.join(operations), callbacks
+
+    def _succeeded(self, result, callbacks):
+        '''
+        Call the functions waiting for queued operations, unless the
+        command that ran them failed.  If it raised, they're never called.
+
+        :type result: string
+        :param result: output of the command
+        :type callbacks: list of functions
+        :param callbacks: functions waiting for the operations
+
+        :rtype: string
+        :return: output of the command
+        '''
+        if not getattr(result, 'failed', False):
+            for callback in callbacks:
+                callback()
+        return result
+
+    def after_flush(self, callback):
+        '''
+        Call a function once the operations queued so far have been run
+        on the host, or right away if nothing is queued.  If running them
+        fails, it isn't called at all.  This is how the push cache only
+        records what has actually been done.
+
+        :type callback: function
+        :param callback: function to call, with no arguments
+        '''
+        with self.lock:
+            if not self.operations:
+                callback()
+            else:
+                self.callbacks.append(callback)
+
+    def run(self, cmd):
+        # the queued operations run first in the same remote command, in
+        # their own shell so they stop at the first failure, with their
+        # output thrown away so it doesn't mix with the command's
+        with self.lock:
+            script, callbacks = self._take_script()
+            if script is None:
+                return self._succeeded(cuisine.run(cmd), callbacks)
+            return self._succeeded(
+                cuisine.run('sh -ec %s >/dev/null && {\n%s\n}' %
+                            (pipes.quote(script), cmd)), callbacks)
+
+    def sudo(self, cmd):
+        with self.lock:
+            self.flush()
+            return cuisine.sudo(cmd)
+
+    def file_upload(self, remote_name, local_name):
+        with self.lock:
+            if self.barrier:
+                self.flush()
+            ImmediateTransport.file_upload(self, remote_name, local_name)
+
+    def file_write(self, remote_name, content):
+        with self.lock:
+            if self.barrier:
+                self.flush()
+            ImmediateTransport.file_write(self, remote_name, content)
+
+    def _attribs(self, path, owner, group, mode):
+        '''
+        Build the commands that set a path's owner, group, and
+        permissions.
+
+        :type path: string
+        :param path: remote path
+        :type owner: string
+        :param owner: owner of the path
+        :type group: string
+        :param group: group of the path
+        :type mode: string
+        :param mode: permissions for the path
+
+        :rtype: list of strings
+        :return: shell commands
+        '''
+        commands = []
+        path = pipes.quote(path)
+        if mode:
+            commands.append('chmod %s %s' % (pipes.quote(mode), path))
+        if owner:
+            commands.append('chown %s %s' % (pipes.quote(owner), path))
+        if group:
+            commands.append('chgrp %s %s' % (pipes.quote(group), path))
+        return commands
+
+    def dir_ensure(self, path, owner=None, group=None, mode=None):
+        self._queue(['mkdir -p %s' % pipes.quote(path)] +
+                    self._attribs(path, owner, group, mode), barrier=True)
+
+    def file_attribs(self, path, owner=None, group=None, mode=None):
+        self._queue(self._attribs(path, owner, group, mode))
+
+    def file_link(self, source, destination):
+        self._queue(['ln -sfn %s %s' % (pipes.quote(source),
+                                        pipes.quote(destination))])
+
+    def file_unlink(self, path):
+        path = pipes.quote(path)
+        self._queue(['if [ -e %s ] || [ -L %s ]; then rm -f %s; fi' %
+                     (path, path, path)])
+
+    def user_ensure(self, name):
+        name = pipes.quote(name)
+        self._queue(['getent passwd %s >/dev/null || useradd -m %s' %
+                     (name, name)], barrier=True)
+
+    def group_ensure(self, name):
+        name = pipes.quote(name)
+        self._queue(['getent group %s >/dev/null || groupadd %s' %
+                     (name, name)], barrier=True)
+
+    def group_user_ensure(self, group, user):
+        group = pipes.quote(group)
+        user = pipes.quote(user)
+        self._queue(['id -nG %s | tr " " "\\n" | grep -qx %s || '
+                     'usermod -a -G %s %s' % (user, group, group, user)],
+                    barrier=True)
+
+    def flush(self):
+        '''
+        Run the queued operations, if there are any, in one remote
+        command.
+        '''
+        with self.lock:
+            script, callbacks = self._take_script()
+            if script is None:
+                self._succeeded('', callbacks)
+            else:
+                self._succeeded(cuisine.run('set -e\n' + script), callbacks)
+
+    @contextlib.contextmanager
+    def batch(self):
+        '''
+        Queue operations until the end of the block, then run them.
+        Batches can be nested; the operations are run at the end of the
+        outermost one.  If the block raises an exception they're left
+        queued.
+        '''
+        depth = getattr(self.local, 'depth', 0)
+        self.local.depth = depth + 1
+        try:
+            yield
+        finally:
+            self.local.depth = depth
+        if depth == 0:
+            self.flush()
+
+
+def get_transport(settings):
+    '''
+    Get the transport for the host fabric is currently pointed at,
+    creating it the first time it's asked for.
+
+    :type settings: dict
+    :param settings: settings dictionary
+
+    :rtype: ImmediateTransport
+    :return: transport for the current host, a BatchingTransport if the "batch_commands" setting is true
+    '''
+    host = env.host_string
+    transport = _transports.get(host)
+    if transport is None:
+        with _transports_lock:
+            if host not in _transports:
+                if settings.get("batch_commands"):
+                    _transports[host] = BatchingTransport()
+                else:
+                    _transports[host] = ImmediateTransport()
+            transport = _transports[host]
+    return transport
+
+
+def flush_transport():
+    '''
+    Run any operations queued for the host fabric is currently pointed
+    at.
+    '''
+    transport = _transports.get(env.host_string)
+    if transport is not None:
+        transport.flush()
@@ -36,19 +36,41 @@ cookbooks and applies them to computers.
 '''
 
 import argparse
+import copy
+import cPickle
+import hashlib
 import json
 import os
 import shutil
 import sys
 import tempfile
+import traceback
+import uuid
 
 import cuisine
 from fabric.api import env
-from fabric.network import disconnect_all
+from frycook import connections
+from frycook import facts
+from frycook import handlers
+from frycook import package_plan
+from frycook import packages
+from frycook import prerender
+from frycook import push_cache
+from frycook import timing
+from frycook.environment import Environment
+from frycook.executor import ProcessExecutor
+from frycook.local_cache import get_cache_dir
+from frycook.registry import Registry
+from frycook.scheduler import RecipeScheduler, is_plain_cookbook
 
+# the recipe and cookbook lists can name their classes as strings, so
+# importing the packages themselves doesn't import every recipe
 import cookbooks
 import recipes
 
+recipe_registry = Registry('recipes', recipes.recipes)
+cookbook_registry = Registry('cookbooks', cookbooks.cookbooks)
+
 
 def replace_tilde_in_path(path):
     return path.replace('~', os.environ['HOME'])
@@ -61,14 +83,16 @@ def get_args():
     :rtype: argparse args object
     :return: object containing attributes for all possible command-line arguments
     '''
-    recipe_names = recipes.recipes.keys()
-    recipe_names.sort()
-    cookbook_names = cookbooks.cookbooks.keys()
-    cookbook_names.sort()
+    recipe_names = recipe_registry.names()
+    cookbook_names = cookbook_registry.names()
 
     parser = argparse.ArgumentParser(description='Setup machines.')
     parser.add_argument('-a', '--apply', action='store_true', default=False,
                         help='apply components to named servers')
+    parser.add_argument('-b', '--batch-size', type=int, default=0,
+                        dest='batch_size', metavar='N',
+                        help='roll out to N hosts at a time, health checking '
+                        'each batch before starting the next')
     parser.add_argument('-c', '--cookbook', dest='cookbooks', action='append',
                         choices=cookbook_names,
                         help='cookbook to process (can specify multiple times)'
@@ -78,10 +102,21 @@ def get_args():
                         'and see which hosts to apply to')
     parser.add_argument('-e', '--environment', default='environment.json',
                         help='environment file')
+    parser.add_argument('--host-timeout', type=int, default=0,
+                        dest='host_timeout', metavar='SECONDS',
+                        help='stop applying to a host after SECONDS and count '
+                        'it as failed (default no limit)')
+    parser.add_argument('-j', '--parallel', type=int, default=1, metavar='N',
+                        help='apply to up to N hosts at once, each in its own '
+                        'process (default 1)')
     parser.add_argument('-k', '--keyfile',
                         help='full path to ssh key file to use')
     parser.add_argument('-m', '--messages', action='store_true', default=False,
                         help='do not apply actions, just print messages')
+    parser.add_argument('--max-failures', type=int, default=0,
+                        dest='max_failures', metavar='N',
+                        help='in a rolling apply, stop once more than N hosts '
+                        'have failed (default 0)')
     parser.add_argument('-n', '--no-prompt', action='store_true', default=False,
                         dest='no_prompt', help='do not prompt user for '
                         'anything; good for automated scripts')
@@ -95,15 +130,24 @@ def get_args():
     parser.add_argument('-P', '--param', dest='params', action='append',
                         help='extra parameters to pass in to recipes and '
                         'cookbooks (key:value) (can specify multiple times)')
+    parser.add_argument('--report', metavar='FILE',
+                        help='write a JSON report of how long everything '
+                        'took to FILE, and print the slowest operations')
     parser.add_argument('-r', '--recipe', dest='recipes', action='append',
                         choices=recipe_names,
                         help='recipe to process (can specify multiple times)')
     parser.add_argument('-s', '--settings', default='settings.json',
                         help='settings file')
+    parser.add_argument('--slowest', type=int, default=10, metavar='N',
+                        help='with --report, how many of the slowest '
+                        'operations to print (default 10)')
     parser.add_argument('-S', '--sudo', action='store_true', default=False,
                         help='run all commands on client as sudo')
     parser.add_argument('-u', '--user', default='root',
                         help='user to ssh to host as')
+    parser.add_argument('--verify-cache', action='store_true', default=False,
+                        dest='verify_cache', help='check the push cache '
+                        'against each host before trusting it')
     parser.add_argument('target', nargs='+',
                         help='computer or group to apply setup to')
 
@@ -157,18 +201,32 @@ def load_settings(filename, params):
     return settings
 
 
-def load_enviro(filename):
+def _resolve_enviro(filename, resolved, stack):
     '''
-    Load the environment json file, loading additionaly imported
-    environment files and massaging environment paths in the
-    process.
+    Load an environment json file and the files it imports.  Each file is
+    only read and parsed once; files that are imported more than once get
+    copies of the first result.
 
     :type filename: string
     :param filename: filename of environment file to read
+    :type resolved: dictionary
+    :param resolved: absolute filename -> environment loaded from it so far
+    :type stack: list of strings
+    :param stack: absolute filenames of the files importing this one
 
     :rtype: dictionary
     :return: dictionary representation of environment
+
+    :raises InvalidEnvironment: raised if environment files import each other
     '''
+    path = os.path.abspath(filename)
+    if path in stack:
+        raise InvalidEnvironment(
+            "environment files import each other: %s" %
+            ' -> '.join(stack[stack.index(path):] + [path]))
+    if path in resolved:
+        return copy.deepcopy(resolved[path])
+
     try:
         enviro = json.load(open(filename))
     except Exception:
@@ -176,17 +234,106 @@ def load_enviro(filename):
         raise
     massage_enviro_paths(enviro)
 
+    stack.append(path)
     for key in enviro:
         if 'imports' in enviro[key]:
             for imp_file in enviro[key]['imports']:
-                imp_enviro = load_enviro(imp_file)
+                imp_enviro = _resolve_enviro(imp_file, resolved, stack)
                 for imp_key in imp_enviro:
                     enviro[key][imp_key] = imp_enviro[imp_key]
             del enviro[key]['imports']
+    stack.pop()
 
+    resolved[path] = enviro
     return enviro
 
 
+def _enviro_signature(filenames):
+    '''
+    Get the modification time and size of each environment file, to tell
+    if a saved environment is still good.
+
+    :type filenames: list of strings
+    :param filenames: absolute filenames of environment files
+
+    :rtype: list of lists
+    :return: [filename, mtime, size] for each file
+    '''
+    signature = []
+    for filename in sorted(filenames):
+        info = os.stat(filename)
+        signature.append([filename, info.st_mtime, info.st_size])
+    return signature
+
+
+def load_enviro(filename, settings=None):
+    '''
+    Load the environment json file, loading additionaly imported
+    environment files and massaging environment paths in the
+    process.  Each file is only parsed once, however many times it's
+    imported.
+
+    The environment is returned as an Environment, which indexes its
+    computers and groups.  If the "enviro_cache" setting is on, the
+    loaded environment is saved in frycook's cache directory, indexes
+    and all, and reused until one of the files it was loaded from
+    changes.
+
+    :type filename: string
+    :param filename: filename of environment file to read
+    :type settings: dictionary
+    :param settings: settings dictionary
+
+    :rtype: Environment
+    :return: dictionary representation of environment
+
+    :raises InvalidEnvironment: raised if environment files import each other
+    '''
+    if not settings or not settings.get("enviro_cache"):
+        return Environment(_resolve_enviro(filename, {}, []))
+
+    # the environment depends on the home directory, since it's
+    # substituted for '~' in paths
+    key = repr((os.path.abspath(filename), os.environ['HOME']))
+    snapshot = os.path.join(get_cache_dir(settings, 'enviro'),
+                            hashlib.sha1(key).hexdigest() + '.pickle')
+    try:
+        f = open(snapshot, 'rb')
+        try:
+            signature, enviro = cPickle.load(f)
+        finally:
+            f.close()
+        if _enviro_signature([s[0] for s in signature]) == signature:
+            if not isinstance(enviro, Environment):
+                enviro = Environment(enviro)
+            return enviro
+    except Exception:
+        # a missing or damaged snapshot, or one pickled by an older
+        # version of frycook, can raise nearly anything; just resolve
+        # the environment again
+        pass
+
+    resolved = {}
+    enviro = Environment(_resolve_enviro(filename, resolved, []))
+    tmp_name = '%s.%d.tmp' % (snapshot, os.getpid())
+    f = open(tmp_name, 'wb')
+    try:
+        cPickle.dump((_enviro_signature(resolved.keys()), enviro), f,
+                     cPickle.HIGHEST_PROTOCOL)
+    finally:
+        f.close()
+    os.rename(tmp_name, snapshot)
+    return enviro
+
+
+class InvalidEnvironment(Exception):
+    '''
+    An InvalidEnvironment exception is raised when the environment files
+    can't be loaded.
+    '''
+    pass
+
+
 class InvalidTarget(Exception):
     '''
     An InvalidTarget exception is raised for exceptional conditions
@@ -195,12 +342,22 @@ class InvalidTarget(Exception):
     pass
 
 
+class HostApplyException(Exception):
+    '''
+    A HostApplyException exception is raised after a parallel apply when
+    one or more hosts failed.
+    '''
+    pass
+
+
 def generate_target_list(enviro, args):
     '''
     Get a list of computers to run against from the command-line
-    arguments.  Translate group names into lists of computers.
+    arguments.  Translate group names into lists of computers.  Each
+    computer is only listed once, no matter how many times it was named
+    directly or through groups.
 
-    :type enviro: dictionary
+    :type enviro: Environment
     :param enviro: environment to read group lists from
     :type args: args object
     :param args: object containing attributes for all possible command-line parameters
@@ -209,17 +366,77 @@ def generate_target_list(enviro, args):
     :return: list of computer names to run against
     '''
     host_list = []
+    seen = set()
     for target in args.target:
         if target in enviro['computers']:
-            host_list.append(target)
-        elif target in enviro['groups']:
-            host_list.extend(enviro['groups'][target]['computers'])
+            targets = [target]
+        elif target in enviro.group_members:
+            targets = enviro.members(target)
         else:
             raise InvalidTarget("Invalid target '%s' encountered" % target)
             sys.exit(2)
+        for host in targets:
+            if host not in seen:
+                seen.add(host)
+                host_list.append(host)
     return host_list
 
 
+def normalize_run_list(host_run_list):
+    '''
+    Flatten the cookbooks in a run list into the recipes that make them
+    up and drop anything that appears more than once, keeping the first
+    occurrence.  Recipes that came from a cookbook have a "cookbook" key
+    naming it.  Cookbooks that do more than apply their recipes, or that
+    have recipes that aren't in the recipes list, are kept whole.
+
+    :type host_run_list: list of dictionaries
+    :param host_run_list: recipes and cookbooks for a host
+
+    :rtype: list of dictionaries
+    :return: normalized run list
+    '''
+    normalized = []
+    seen = set()
+    for item in host_run_list:
+        items = [item]
+        if item["type"] == "cookbook":
+            cls = cookbook_registry.get(item["name"])
+            recipe_names = [recipe_registry.name_of(r)
+                            for r in cls.recipe_list]
+            if is_plain_cookbook(cls) and None not in recipe_names:
+                items = [{"type": "recipe", "name": name,
+                          "cookbook": item["name"]}
+                         for name in recipe_names]
+        for i in items:
+            if (i["type"], i["name"]) not in seen:
+                seen.add((i["type"], i["name"]))
+                normalized.append(i)
+    return normalized
+
+
+def output_run_plan(host_list, run_list):
+    '''
+    Print the normalized run list for each host.
+
+    :type host_list: list of strings
+    :param host_list: list of hosts to run against
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+    '''
+    print "run plan:"
+    for host in host_list:
+        steps = []
+        for item in run_list[host]:
+            if item["type"] == "cookbook":
+                steps.append("cookbook %s" % item["name"])
+            elif "cookbook" in item:
+                steps.append("%s (%s)" % (item["name"], item["cookbook"]))
+            else:
+                steps.append(item["name"])
+        print "    %s: %s" % (host, ', '.join(steps))
+
+
 def generate_run_list(enviro, args):
     '''
     Get the lists of computers, recipes, cookbooks, and run list to run
@@ -228,7 +445,9 @@ def generate_run_list(enviro, args):
     run list will just specify the same recipes and cookbooks for each
     computer, unless a list of computers was given and the apply (-a)
     command-line argument was specified.  In that case each computer
-    could have different things run against them.
+    could have different things run against them.  Each computer's run
+    list is normalized, so cookbooks are flattened into their recipes and
+    nothing is applied to a computer twice.
 
     :type enviro: dictionary
     :param enviro: environment to read group lists and computer components from
@@ -263,6 +482,14 @@ def generate_run_list(enviro, args):
             cookbooks.update(args.cookbooks)
         if args.recipes:
             recipes.update(args.recipes)
+
+    # most hosts share the same run list, so only normalize each one once
+    normalized = {}
+    for host in host_list:
+        key = tuple([(item["type"], item["name"]) for item in run_list[host]])
+        if key not in normalized:
+            normalized[key] = normalize_run_list(run_list[host])
+        run_list[host] = normalized[key]
     return run_list, host_list, recipes, cookbooks
 
 
@@ -283,12 +510,12 @@ def output_pre_apply_messages(recipe_list, cookbook_list, enviro, settings, args
     :param args: object containing attributes for all possible command-line parameters
     '''
     for r in recipe_list:
-        recipe = recipes.recipes[r](
+        recipe = recipe_registry.get(r)(
             settings, enviro, args.ok_to_be_rude, args.no_prompt)
         recipe.handle_pre_apply_message()
 
     for c in cookbook_list:
-        cookbook = cookbooks.cookbooks[c](
+        cookbook = cookbook_registry.get(c)(
             settings, enviro, args.ok_to_be_rude, args.no_prompt)
         cookbook.handle_pre_apply_messages()
 
@@ -310,19 +537,209 @@ def output_post_apply_messages(recipe_list, cookbook_list, enviro, settings, arg
     :param args: object containing attributes for all possible command-line parameters
     '''
     for r in recipe_list:
-        recipe = recipes.recipes[r](
+        recipe = recipe_registry.get(r)(
             settings, enviro, args.ok_to_be_rude, args.no_prompt)
         recipe.handle_post_apply_message()
 
     for c in cookbook_list:
-        cookbook = cookbooks.cookbooks[c](
+        cookbook = cookbook_registry.get(c)(
             settings, enviro, args.ok_to_be_rude, args.no_prompt)
         cookbook.handle_post_apply_messages()
 
 
-def apply_recipes_cookbooks(enviro, settings, args, host_list, run_list):
+def make_components(enviro, settings, args, host_run_list):
     '''
-    Apply all specified recipes and cookbooks to the requested hosts.
+    Create the recipes and cookbooks in a host's run list.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host_run_list: list of dictionaries
+    :param host_run_list: recipes and cookbooks to apply to the host
+
+    :rtype: list of Recipe and Cookbook objects
+    :return: recipes and cookbooks, in run list order
+    '''
+    components = []
+    for item in host_run_list:
+        if item["type"] == "recipe":
+            components.append(recipe_registry.get(item["name"])(
+                settings, enviro, args.ok_to_be_rude, args.no_prompt))
+        elif item["type"] == "cookbook":
+            components.append(cookbook_registry.get(item["name"])(
+                settings, enviro, args.ok_to_be_rude, args.no_prompt))
+    return components
+
+
+def start_prerender(enviro, settings, args, host_list, run_list):
+    '''
+    Start rendering the templates for a list of hosts that will be
+    applied to one at a time, if the "prerender_templates" setting is
+    true and there's more than one host.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host_list: list of strings
+    :param host_list: list of hosts, in the order they'll be applied to
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+
+    :rtype: Prerenderer
+    :return: prerenderer, or None if templates aren't pre-rendered
+    '''
+    if not settings.get("prerender_templates") or len(host_list) < 2:
+        return None
+    jobs = []
+    for host in host_list:
+        packages = []
+        for component in make_components(enviro, settings, args,
+                                         run_list[host]):
+            for package_name, aux_env in component.prerender_packages(host):
+                packages.append((package_name, prerender.package_template_env(
+                    enviro, host, aux_env)))
+        jobs.append((host, packages))
+    return prerender.Prerenderer(settings, jobs)
+
+
+def apply_host(enviro, settings, args, host, host_run_list):
+    '''
+    Apply the run list for a single host.  This points fabric at the
+    host, connects to it, gathers facts from it, installs the packages
+    needed by the whole run list in one go, and runs every recipe and
+    cookbook in its run list through the scheduler.  Handlers notified
+    along the way are run once at the end, even if a recipe failed, since
+    the changes that notified them are already on the host.  Then the
+    health checks are run.  The connection is left open;
+    connections.disconnect() closes it once the caller is done with the
+    host.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host: string
+    :param host: name of the host to apply to
+    :type host_run_list: list of dictionaries
+    :param host_run_list: recipes and cookbooks to apply to the host
+    '''
+    env.host_string = host
+    if args.user:
+        env.user = args.user
+    if args.keyfile:
+        env.key_filename = args.keyfile
+
+    with timing.timed('host'):
+        try:
+            connections.connect()
+
+            components = make_components(enviro, settings, args,
+                                         host_run_list)
+
+            paths = []
+            package_names = []
+            push_packages = set()
+            for component in components:
+                paths.extend(component.remote_paths)
+                package_names.extend(component.packages)
+                push_packages.update(component.push_packages)
+            for package_name in sorted(push_packages):
+                plan = package_plan.get_package_plan(settings, package_name)
+                paths.extend([op.remote_path for op in plan
+                              if op.action == package_plan.DIRECTORY])
+            with timing.timed('facts'):
+                facts.gather_facts(sorted(set(paths)))
+
+            with timing.timed('packages'):
+                if args.package_update:
+                    packages.update_packages(
+                        settings.get("package_update_max_age"))
+                packages.install_packages(package_names)
+
+            scheduler = RecipeScheduler(components)
+            try:
+                scheduler.run(host)
+            except:
+                # the files that notified these handlers are already on
+                # the host and in the push cache, so the next run won't
+                # notify them again; run them now rather than lose them
+                exc_info = sys.exc_info()
+                pending = handlers.pending_handlers()
+                if pending:
+                    print "running handlers notified before the failure " \
+                        "on %s: %s" % (host, ", ".join(pending))
+                    try:
+                        with timing.timed('handlers'):
+                            handlers.run_handlers()
+                    except (Exception, SystemExit):
+                        # fabric aborts with SystemExit; report the
+                        # recipe's error, not the handler's
+                        traceback.print_exc()
+                raise exc_info[0], exc_info[1], exc_info[2]
+            with timing.timed('handlers'):
+                handlers.run_handlers()
+            scheduler.health_check(host)
+        finally:
+            # whatever is still queued after a failure mustn't be left
+            # for the next apply to the same host string
+            handlers.clear_handlers()
+            push_cache.save_push_caches()
+
+
+# state shared with the worker processes of a parallel apply; set by
+# _init_worker() before they're forked, so they inherit it instead of
+# having it pickled for every host
+_worker_state = {}
+
+
+def _build_plans(enviro, settings, args, host_list, run_list):
+    '''
+    Work out the plans for every package the hosts' recipes list in
+    push_packages, so that worker processes forked afterwards inherit
+    them instead of each walking and hashing the packages again.  A
+    package whose plan can't be worked out is left for the host's own
+    apply to report.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host_list: list of strings
+    :param host_list: list of hosts to run against
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+    '''
+    seen = set()
+    push_packages = set()
+    for host in host_list:
+        key = tuple([(item["type"], item["name"]) for item in run_list[host]])
+        if key in seen:
+            continue
+        seen.add(key)
+        for component in make_components(enviro, settings, args,
+                                         run_list[host]):
+            push_packages.update(component.push_packages)
+    for package_name in sorted(push_packages):
+        try:
+            package_plan.get_package_plan(settings, package_name)
+        except Exception:
+            pass
+
+
+def _init_worker(enviro, settings, args, host_list, run_list):
+    '''
+    Set the state the worker processes of a parallel apply need, and
+    build what they can share, before any of them are forked.
 
     :type enviro: dictionary
     :param enviro: environment dictionary
@@ -335,28 +752,310 @@ def apply_recipes_cookbooks(enviro, settings, args, host_list, run_list):
     :type run_list: dictionary
     :param run_list: dictionary of lists
     '''
+    _worker_state["enviro"] = enviro
+    _worker_state["settings"] = settings
+    _worker_state["args"] = args
+    _build_plans(enviro, settings, args, host_list, run_list)
+    # make the workers share this process's control directory, so the
+    # control masters of workers that get killed can be found and stopped
+    connections.get_control_dir()
+
+
+def _clean_up_worker(job):
+    '''
+    Clean up after a worker process that was killed or died before it
+    could disconnect from its host.
+
+    :type job: tuple of (string, list)
+    :param job: (host name, run list for the host)
+    '''
+    connections.exit_control_masters(job[0])
+
+
+def _apply_host_worker(job):
+    '''
+    Apply the run list for one host inside a worker process.  Each host
+    gets a worker process of its own, with its own copy of fabric's env
+    and connection cache, and its own copy of the settings with a private
+    tmp dir.
+    Exceptions are caught and reported back instead of being raised so
+    that one bad host doesn't stop the others.
+
+    :type job: tuple of (string, list)
+    :param job: (host name, run list for the host)
+
+    :rtype: tuple of (string, string, list)
+    :return: (host name, error message or None if the apply succeeded,
+              timing records for the host)
+    '''
+    host, host_run_list = job
+    settings = dict(_worker_state["settings"])
+    settings["tmp_dir"] = tempfile.mkdtemp(dir=settings["tmp_dir"])
+    timing.clear_records()
+    error = None
+    try:
+        apply_host(_worker_state["enviro"], settings, _worker_state["args"],
+                   host, host_run_list)
+    except (Exception, SystemExit), e:
+        # fabric aborts with SystemExit, which would kill the worker
+        print "[%s] apply failed:" % host
+        traceback.print_exc()
+        error = "%s: %s" % (e.__class__.__name__, e)
+    finally:
+        connections.disconnect()
+        shutil.rmtree(settings["tmp_dir"], ignore_errors=True)
+    return host, error, timing.get_records()
+
+
+def output_host_summary(host_list, results):
+    '''
+    Print the success or failure of each host in a parallel apply.
+
+    :type host_list: list of strings
+    :param host_list: list of hosts that were run against
+    :type results: dictionary
+    :param results: host name -> error message, or None if it succeeded
+    '''
+    print "host summary:"
     for host in host_list:
-        env.host_string = host
-        if args.user:
-            env.user = args.user
-        if args.keyfile:
-            env.key_filename = args.keyfile
+        if results.get(host, "not run") is None:
+            print "    %s: ok" % host
+        else:
+            print "    %s: FAILED (%s)" % (host, results.get(host, "not run"))
+
+
+def apply_hosts(enviro, settings, args, executor, host_list, run_list):
+    '''
+    Apply the run lists for a list of hosts, either in worker processes
+    or one at a time in this process, pre-rendering templates for the
+    hosts to come if that's turned on.  Failures are reported instead of
+    raised, so every host is attempted.  A host that runs out of time in
+    a worker process counts as failed.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type executor: ProcessExecutor
+    :param executor: executor to apply in, or None to apply one host at a time
+    :type host_list: list of strings
+    :param host_list: list of hosts to run against
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+
+    :rtype: iterator of tuples of (string, string)
+    :return: (host name, error message or None if the apply succeeded), in
+             the order the hosts finish
+    '''
+    if executor is not None:
+        jobs = [(host, run_list[host]) for host in host_list]
+        for job, result, error in executor.run(jobs):
+            if error is not None:
+                print "[%s] apply failed: %s" % (job[0], error)
+                yield job[0], error
+                continue
+            host, error, records = result
+            timing.add_records(records)
+            yield host, error
+        return
+
+    prerenderer = start_prerender(enviro, settings, args, host_list,
+                                  run_list)
+    try:
+        for host in host_list:
+            error = None
+            try:
+                if prerenderer is not None:
+                    prerenderer.wait_for(host)
+                apply_host(enviro, settings, args, host, run_list[host])
+            except (Exception, SystemExit), e:
+                print "[%s] apply failed:" % host
+                traceback.print_exc()
+                error = "%s: %s" % (e.__class__.__name__, e)
+            connections.disconnect(host)
+            if prerenderer is not None:
+                prerenderer.discard(host)
+            yield host, error
+    finally:
+        if prerenderer is not None:
+            prerenderer.close()
+
+
+def check_host_results(host_list, results):
+    '''
+    Print the host summary and raise if any host failed or wasn't run.
+
+    :type host_list: list of strings
+    :param host_list: list of hosts that were to be run against
+    :type results: dictionary
+    :param results: host name -> error message, or None if it succeeded
+
+    :raises HostApplyException: raised if any host failed or wasn't run
+    '''
+    output_host_summary(host_list, results)
+    failed = [host for host in host_list
+              if results.get(host, "not run") is not None]
+    if failed:
+        raise HostApplyException("%d of %d hosts failed or were not run: %s"
+                                 % (len(failed), len(host_list),
+                                    ', '.join(failed)))
+
 
-        if args.package_update:
-            cuisine.package_update()
+def apply_parallel(enviro, settings, args, host_list, run_list):
+    '''
+    Apply all specified recipes and cookbooks to the requested hosts,
+    running up to args.parallel hosts at once, each in a worker process
+    of its own.  A host that takes longer than args.host_timeout seconds
+    is stopped.  Every host is attempted even if some fail.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host_list: list of strings
+    :param host_list: list of hosts to run against
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+
+    :raises HostApplyException: raised if any host failed
+    '''
+    results = {}
+    _init_worker(enviro, settings, args, host_list, run_list)
+    executor = ProcessExecutor(_apply_host_worker,
+                               min(args.parallel, len(host_list)),
+                               args.host_timeout or None,
+                               _clean_up_worker)
+    for host, error in apply_hosts(enviro, settings, args, executor,
+                                   host_list, run_list):
+        results[host] = error
+        print "finished %s (%d of %d): %s" % (
+            host, len(results), len(host_list),
+            "ok" if error is None else "FAILED")
+
+    check_host_results(host_list, results)
 
+
+def apply_rolling(enviro, settings, args, host_list, run_list):
+    '''
+    Apply all specified recipes and cookbooks to the requested hosts in
+    batches of args.batch_size hosts.  Each host is health checked as
+    soon as it has been applied to, and a batch only starts once the one
+    before it is completely done.  Once more than args.max_failures hosts
+    have failed, no more batches are started.  Within a batch, up to
+    args.parallel hosts are applied to at once, and hosts are applied in
+    worker processes if there's more than one at once or if
+    args.host_timeout limits how long each can take.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host_list: list of strings
+    :param host_list: list of hosts to run against
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+
+    :raises HostApplyException: raised if any host failed or wasn't run
+    '''
+    batches = [host_list[i:i + args.batch_size]
+               for i in range(0, len(host_list), args.batch_size)]
+    results = {}
+    failures = 0
+    executor = None
+    if args.parallel > 1 or args.host_timeout:
+        _init_worker(enviro, settings, args, host_list, run_list)
+        executor = ProcessExecutor(_apply_host_worker,
+                                   min(args.parallel, args.batch_size),
+                                   args.host_timeout or None,
+                                   _clean_up_worker)
+    try:
+        for num, batch in enumerate(batches):
+            print "starting batch %d of %d: %s" % (num + 1, len(batches),
+                                                   ', '.join(batch))
+            for host, error in apply_hosts(enviro, settings, args, executor,
+                                           batch, run_list):
+                results[host] = error
+                if error is not None:
+                    failures += 1
+                print "finished %s (%d of %d): %s" % (
+                    host, len(results), len(host_list),
+                    "ok" if error is None else "FAILED")
+            if failures > args.max_failures:
+                print ("halting rollout: %d hosts failed, more than the %d "
+                       "allowed" % (failures, args.max_failures))
+                break
+    finally:
+        connections.disconnect()
+
+    check_host_results(host_list, results)
+
+
+def apply_recipes_cookbooks(enviro, settings, args, host_list, run_list):
+    '''
+    Apply all specified recipes and cookbooks to the requested hosts.
+    Hosts are done one at a time unless args.parallel is more than one,
+    and all at once unless args.batch_size asks for a rolling apply.
+    When hosts are done one at a time, their templates can be rendered
+    ahead of time in other processes; see frycook.prerender.  If
+    args.host_timeout is set, each host is applied in a worker process so
+    it can be stopped when it runs out of time.
+
+    :type enviro: dictionary
+    :param enviro: environment dictionary
+    :type settings: dictionary
+    :param settings: settings dictionary
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type host_list: list of strings
+    :param host_list: list of hosts to run against
+    :type run_list: dictionary
+    :param run_list: dictionary of lists
+    '''
+    if args.batch_size > 0:
+        apply_rolling(enviro, settings, args, host_list, run_list)
+    elif (args.parallel > 1 and len(host_list) > 1) or args.host_timeout:
+        apply_parallel(enviro, settings, args, host_list, run_list)
+    else:
+        prerenderer = start_prerender(enviro, settings, args, host_list,
+                                      run_list)
         try:
-            for item in run_list[host]:
-                if item["type"] == "recipe":
-                    recipe = recipes.recipes[item["name"]](
-                        settings, enviro, args.ok_to_be_rude, args.no_prompt)
-                    recipe.run_apply(host)
-                elif item["type"] == "cookbook":
-                    cookbook = cookbooks.cookbooks[item["name"]](
-                        settings, enviro, args.ok_to_be_rude, args.no_prompt)
-                    cookbook.run_apply(host)
+            for host in host_list:
+                if prerenderer is not None:
+                    prerenderer.wait_for(host)
+                try:
+                    apply_host(enviro, settings, args, host, run_list[host])
+                finally:
+                    # a serial run never comes back to a host, so don't
+                    # hold a socket and an ssh process open for each one
+                    connections.disconnect(host)
+                if prerenderer is not None:
+                    prerenderer.discard(host)
         finally:
-            disconnect_all()
+            if prerenderer is not None:
+                prerenderer.close()
+            connections.disconnect()
+
+
+def output_timing_report(args, settings):
+    '''
+    Write the timing report for the run and print the slowest operations.
+
+    :type args: args object
+    :param args: object containing attributes for all possible command-line parameters
+    :type settings: dictionary
+    :param settings: settings dictionary
+    '''
+    records = timing.get_records()
+    timing.write_report(args.report, records, settings.get("run_id"))
+    if args.slowest > 0:
+        timing.output_slowest(records, args.slowest)
+    print "timing report written to %s" % args.report
 
 
 def main():
@@ -366,7 +1065,9 @@ def main():
     args = get_args()
 
     settings = load_settings(args.settings, args.params)
-    enviro = load_enviro(args.environment)
+    settings["verify_push_cache"] = args.verify_cache
+    settings["run_id"] = uuid.uuid4().hex
+    enviro = load_enviro(args.environment, settings)
 
     try:
         if args.sudo:
@@ -379,6 +1080,7 @@ def main():
         if args.dryrun:
             print ("actions would be applied to the following hosts: %s" %
                    ', '.join(host_list))
+            output_run_plan(host_list, run_list)
             print ("environment to be used: %s" %
                    json.dumps(enviro, sort_keys=True, indent=4,
                               separators=(',', ': ')))
@@ -386,7 +1088,14 @@ def main():
 
         output_pre_apply_messages(recipes, cookbooks, enviro, settings, args)
         if not args.messages:
-            apply_recipes_cookbooks(enviro, settings, args, host_list, run_list)
+            if args.report:
+                timing.instrument_remote_commands()
+            try:
+                apply_recipes_cookbooks(enviro, settings, args, host_list,
+                                        run_list)
+            finally:
+                if args.report:
+                    output_timing_report(args, settings)
         output_post_apply_messages(recipes, cookbooks, enviro, settings, args)
 
         shutil.rmtree(tmp_dir)